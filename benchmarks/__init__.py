@@ -0,0 +1,3 @@
+"""
+Scaling benchmarks of the preprocessors. Run with python -m benchmarks.run.
+"""
@@ -0,0 +1,329 @@
+"""
+Scaling benchmark of the structured preprocessors.
+
+Sweeps mesh size and coarsening ratio for the multiscale (3-D and 2-D) and
+upscaling (Average and Flow-based) preprocessors. Each case runs in its own
+process, so that its peak memory is its own, and is reported with the wall
+time of each stage, the peak RSS and the size of the files it wrote. Its
+input files are written beforehand by the parent process. The results are
+compared against a stored baseline.
+
+    $ python -m benchmarks.run --sizes 16 32 64 128 256 --ratios 4 8
+    $ python -m benchmarks.run --save-baseline
+
+The upscaling cases read SPE10 (spe_phi.dat and spe_perm.dat) from the
+directory given with --spe10, cut or tiled to the size of each case, and
+fall back to a synthetic log-normal field when it is not given.
+"""
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from presto.Preprocessors.Common.Instrumentation import report_path
+from presto.Preprocessors.Common.PropertyReader import read_property
+
+
+SUITES = {
+    'multiscale': ('presto.Preprocessors.Multiscale.Structured', 3, None),
+    'multiscale-2d': ('presto.Preprocessors.Multiscale.Structured2D', 2, None),
+    'upscale-average': ('presto.Preprocessors.Upscale.Structured', 3,
+                        'Average'),
+    'upscale-flow-based': ('presto.Preprocessors.Upscale.Structured', 3,
+                           'Flow-based'),
+}
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+SPE10_SIZE = (60, 220, 85)
+
+# Separator of the SPE10 files
+SEPARATOR = '        \t'
+
+
+def case_name(case):
+    return "{suite}/{size}^{ndim}/ratio-{ratio}".format(**case)
+
+
+def cases(suites, sizes, ratios):
+    for suite in suites:
+        ndim = SUITES[suite][1]
+        for size in sizes:
+            for ratio in ratios:
+                if ratio <= size:
+                    yield {'suite': suite, 'ndim': ndim, 'size': size,
+                           'ratio': ratio}
+
+
+def synthetic_properties(mesh_size, seed=0):
+    """Log-normal, layered permeability field and correlated porosity, in
+    (x, y, z) permeability blocks as in SPE10."""
+    rng = np.random.RandomState(seed)
+    n_cells = int(np.prod(mesh_size))
+    layers = rng.normal(0.0, 1.5, mesh_size[2]).repeat(n_cells //
+                                                       mesh_size[2])
+
+    log_perm = layers + rng.normal(0.0, 1.0, n_cells)
+    perm_x = np.exp(log_perm + 3.0)
+    perm = np.concatenate((perm_x, perm_x, 0.1 * perm_x))
+    phi = np.clip(0.1 + 0.03 * log_perm, 0.01, 0.4)
+
+    return phi, perm
+
+
+def spe10_properties(spe10_dir, mesh_size):
+    """SPE10 properties cut, or tiled, to mesh_size. The files are read as
+    the upscaling preprocessor reads them, cache included, whatever the
+    number of values on each of their lines."""
+    shape = SPE10_SIZE[::-1]
+    phi = read_property(os.path.join(spe10_dir, 'spe_phi.dat')).reshape(
+        shape)
+    perm = read_property(os.path.join(spe10_dir, 'spe_perm.dat')).reshape(
+        (3,) + shape)
+
+    index = np.ix_(*[np.arange(n) % spe_n for n, spe_n in
+                     zip(mesh_size[::-1], shape)])
+    return (phi[index].ravel(),
+            np.concatenate([component[index].ravel() for component in perm]))
+
+
+def write_property(path, values):
+    # The readers take whitespace separated values, whatever the lines
+    with open(path, 'w') as output:
+        values.tofile(output, sep=SEPARATOR, format='%f')
+
+
+def configs(case, output_file):
+    suite, ndim, method = SUITES[case['suite']]
+    mesh_size = [str(case['size'])] * ndim
+    coarse_ratio = [str(case['ratio'])] * ndim
+    block_size = ['1'] * ndim
+
+    run_configs = {
+        'General': {'output-file': output_file},
+        'Instrumentation': {'quiet': True}
+    }
+    if method is None:
+        section = 'StructuredMS' if ndim == 3 else 'Structured2DMS'
+        run_configs[section] = {
+            'coarse-ratio': coarse_ratio,
+            'mesh-size': mesh_size,
+            'block-size': block_size
+        }
+    else:
+        run_configs['General']['fine-grid'] = 'coarse_grid'
+        run_configs['StructuredUPS'] = {
+            'coarse-ratio': coarse_ratio,
+            'mesh-size': mesh_size,
+            'block-size': block_size,
+            'method': method,
+            'average': 'Arithmetic'
+        }
+
+    return run_configs
+
+
+INPUTS = ('spe_phi.dat', 'spe_perm.dat')
+
+
+def write_inputs(case, spe10_dir, workdir):
+    """Write the property files of an upscaling case to workdir. This runs
+    in the parent process, so that the input arrays do not count in the
+    peak memory of the measured one."""
+    suite, ndim, method = SUITES[case['suite']]
+    if method is None:
+        return
+
+    mesh_size = [case['size']] * ndim
+    if spe10_dir:
+        phi, perm = spe10_properties(spe10_dir, mesh_size)
+    else:
+        phi, perm = synthetic_properties(mesh_size)
+    for name, values in zip(INPUTS, (phi, perm)):
+        write_property(os.path.join(workdir, name), values)
+
+
+def run_case(case):
+    """Run one case in the current process, in the current directory, which
+    holds its inputs."""
+    from pymoab import core
+
+    suite, ndim, method = SUITES[case['suite']]
+    output_file = os.path.abspath('benchmark.h5m')
+
+    moab = core.Core()
+    preprocessor = importlib.import_module(suite).Preprocessor(
+        configs(case, output_file))
+    preprocessor.run(moab)
+    if method is None:
+        moab.write_file(output_file)
+
+    with open(report_path(output_file)) as report_file:
+        report = json.load(report_file)
+
+    # Inputs, their binary caches and the reports are not outputs
+    outputs = [name for name in os.listdir('.')
+               if not name.startswith(INPUTS) and
+               not name.endswith('.json') and not name.endswith('.prof')]
+
+    return {
+        'wall_time': report['wall_time'],
+        'peak_rss': report['peak_rss'],
+        'output_size': sum(os.path.getsize(name) for name in outputs),
+        'stages': dict((stage['name'], stage['wall_time'])
+                       for stage in report['stages']),
+        'counters': report['counters']
+    }
+
+
+def spawn_case(case, spe10_dir, timeout):
+    """Run one case in a child process, in a scratch directory."""
+    workdir = tempfile.mkdtemp(prefix='presto-benchmark-')
+    command = [sys.executable, '-m', 'benchmarks.run',
+               '--case', json.dumps(case)]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [path for path in [env.get('PYTHONPATH')] if path])
+
+    try:
+        write_inputs(case, spe10_dir, workdir)
+        child = subprocess.Popen(command, cwd=workdir, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        timer = threading.Timer(timeout, child.kill) if timeout else None
+        if timer is not None:
+            timer.start()
+        try:
+            stdout, stderr = child.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if child.returncode != 0:
+        error = stderr.decode('utf-8', 'replace').strip().splitlines()
+        return {'error': error[-1] if error else
+                'killed after {0} seconds'.format(timeout)}
+
+    return json.loads(stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def metrics(result):
+    values = {
+        'wall_time': result['wall_time'],
+        'peak_rss': result['peak_rss'],
+        'output_size': result['output_size']
+    }
+    for stage, wall_time in result['stages'].items():
+        values['stage: ' + stage] = wall_time
+    return values
+
+
+def compare(results, baseline, threshold, min_time):
+    """List the (case, metric, baseline, value) that grew past threshold.
+    Timings shorter than min_time on both sides are left out as noise."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or 'error' in results[name]:
+            continue
+
+        base_metrics = metrics(baseline[name])
+        for metric, value in sorted(metrics(results[name]).items()):
+            base_value = base_metrics.get(metric)
+            if value is None or not base_value:
+                continue
+            if metric not in ('peak_rss', 'output_size') and max(
+                    value, base_value) < min_time:
+                continue
+            if value > base_value * (1.0 + threshold):
+                regressions.append((name, metric, base_value, value))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Scaling benchmark of the structured preprocessors.")
+    parser.add_argument('--suites', nargs='+', choices=sorted(SUITES),
+                        default=sorted(SUITES))
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[16, 32, 64, 128, 256],
+                        help="Fine cells along each axis.")
+    parser.add_argument('--ratios', nargs='+', type=int, default=[4, 8],
+                        help="Coarsening ratio along each axis.")
+    parser.add_argument('--spe10',
+                        help="Directory holding spe_phi.dat and "
+                        "spe_perm.dat; synthetic properties otherwise.")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store the results as the new baseline.")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative growth reported as a regression.")
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help="Timings below this many seconds are ignored.")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="Seconds after which a case is killed.")
+    parser.add_argument('--output', help="Also write the results here.")
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+
+    results = {}
+    for case in cases(args.suites, args.sizes, args.ratios):
+        name = case_name(case)
+        print("{0}...".format(name))
+        result = results[name] = spawn_case(case, args.spe10, args.timeout)
+        if 'error' in result:
+            print("  failed: {0}".format(result['error']))
+        else:
+            print("  {0:.2f} s, {1:.1f} MB peak, {2:.1f} MB written".format(
+                result['wall_time'], (result['peak_rss'] or 0) / 2.0 ** 20,
+                result['output_size'] / 2.0 ** 20))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print("Baseline written to {0}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {0}; run with --save-baseline to store "
+              "one.".format(args.baseline))
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = compare(results, baseline, args.threshold, args.min_time)
+    for name, metric, base_value, value in regressions:
+        print("REGRESSION {0} [{1}]: {2:.4g} -> {3:.4g} ({4:+.0%})".format(
+            name, metric, base_value, value, value / base_value - 1.0))
+    if not regressions:
+        print("No regression past {0:.0%} of the baseline.".format(
+            args.threshold))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Means of cell values over groups of cells, such as the fine cells of each
+primal volume, computed for all groups at once.
+"""
+import numpy as np
+
+
+# Exponent of the power mean matching each named average
+POWERS = {'Arithmetic': 1.0, 'Harmonic': -1.0, 'Geometric': 0.0}
+
+
+def group_sums(values, groups, n_groups, weights=None):
+    """Sum values over the cells of each group.
+
+    Parameters
+    ----------
+    values: Array of floats
+        (N,) or (N, k) array of cell values.
+    groups: Array of integers
+        (N,) array holding the group of each cell, from 0 to n_groups - 1.
+    n_groups: Integer
+        Number of groups.
+    weights: Array of floats, optional
+        (N,) array of cell weights.
+
+    Returns
+    -------
+    (n_groups,) or (n_groups, k) array of sums, all columns summed in a
+    single pass.
+    """
+    values = np.asarray(values, dtype='float64')
+    if weights is not None:
+        values = values * (weights if values.ndim == 1 else
+                           np.asarray(weights)[:, np.newaxis])
+    if values.ndim == 1:
+        return np.bincount(groups, values, n_groups)
+
+    n_cols = values.shape[1]
+    bins = (np.asarray(groups)[:, np.newaxis] * n_cols +
+            np.arange(n_cols)).ravel()
+    return np.bincount(bins, values.ravel(), n_groups * n_cols).reshape(
+        n_groups, n_cols)
+
+
+def power_mean(values, groups, n_groups, p, weights=None):
+    """Power mean of exponent p of values over the cells of each group:
+    (sum(w * v ** p) / sum(w)) ** (1 / p), and its limit
+    exp(sum(w * log(v)) / sum(w)), the geometric mean, for p = 0.
+
+    Parameters are as in group_sums.
+    """
+    return power_means(values, groups, n_groups, [p], weights)[0]
+
+
+def parse_average(average):
+    """Label and exponent of an average given either by name, as in POWERS,
+    or by the finite exponent of a power mean. Raises ValueError otherwise.
+    """
+    if average in POWERS:
+        return average, POWERS[average]
+
+    p = float(average)
+    if not np.isfinite(p):
+        raise ValueError(
+            "The exponent of a power mean must be finite, not {0}.".format(
+                average))
+    return 'Power{0:g}'.format(p), p
+
+
+def power_means(values, groups, n_groups, powers, weights=None):
+    """Power means of several exponents over the cells of each group, as
+    power_mean does for one.
+
+    The total weight of each group, and the logarithm of the values for the
+    geometric mean, are computed once and shared by all exponents, each of
+    which then takes a single bincount pass.
+
+    Returns
+    -------
+    List holding the means of each exponent in powers, in order.
+    """
+    values = np.asarray(values, dtype='float64')
+    cells_weights = (np.ones(len(values)) if weights is None
+                     else np.asarray(weights, dtype='float64'))
+    totals = group_sums(cells_weights, groups, n_groups)
+    if values.ndim > 1:
+        totals = totals[:, np.newaxis]
+
+    log_values = None
+    means = []
+    with np.errstate(divide='ignore'):
+        # Zero values give the zero geometric and harmonic means they should
+        for p in powers:
+            if p == 0:
+                if log_values is None:
+                    log_values = np.log(values)
+                means.append(np.exp(group_sums(log_values, groups, n_groups,
+                                               weights) / totals))
+            else:
+                powered = values if p == 1 else values ** p
+                means.append((group_sums(powered, groups, n_groups,
+                                         weights) / totals) ** (1.0 / p))
+    return means
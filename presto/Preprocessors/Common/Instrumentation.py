@@ -0,0 +1,210 @@
+"""
+Stage timers, memory figures and counters for the preprocessors' runs.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import re
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, None where unknown."""
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def report_path(output_file):
+    """Path of the JSON report written next to an output file."""
+    return os.path.splitext(output_file)[0] + '.report.json'
+
+
+def as_bool(value):
+    if isinstance(value, string_types):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+class Instrumentation(object):
+    """ Collects named stage timings, memory use and counters of a
+    preprocessor run, and reports them as JSON.
+
+    Parameters
+    ----------
+    quiet: Boolean
+        Silences stage and progress messages.
+    progress_interval: Float
+        Minimum number of seconds between two progress messages.
+    trace_memory: Boolean
+        Records tracemalloc figures for each stage. Needs Python 3.
+    profile: Boolean
+        Runs each stage under cProfile and dumps its statistics next to the
+        report.
+    """
+    def __init__(self, quiet=False, progress_interval=1.0,
+                 trace_memory=False, profile=False):
+        self.quiet = quiet
+        self.progress_interval = progress_interval
+        self.trace_memory = trace_memory and tracemalloc is not None
+        self.profile = profile
+
+        self.stages = []  # One record per stage, in run order
+        self.counters = {}
+        self.profiles = []  # (stage name, cProfile.Profile) pairs
+
+        self._start = time.time()
+        self._last_progress = None
+
+    @classmethod
+    def from_configs(cls, configs):
+        """Build from the optional [Instrumentation] section of a config."""
+        options = configs.get('Instrumentation', {})
+        return cls(
+            quiet=as_bool(options.get('quiet', False)),
+            progress_interval=float(options.get('progress-interval', 1.0)),
+            trace_memory=as_bool(options.get('trace-memory', False)),
+            profile=as_bool(options.get('profile', False)))
+
+    def message(self, text):
+        if not self.quiet:
+            print(text)
+
+    def progress(self, done, total):
+        """Print "done / total", at most once per progress_interval seconds
+        besides the last step."""
+        now = time.time()
+        if self.quiet or (
+                done < total and self._last_progress is not None and
+                now - self._last_progress < self.progress_interval):
+            return
+
+        self._last_progress = now
+        print("{0} / {1}".format(done, total))
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block and record it under name."""
+        self.message("{0}...".format(name))
+
+        counters = dict(self.counters)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            wall_time = time.time() - t0
+            if profiler is not None:
+                profiler.disable()
+                self.profiles.append((name, profiler))
+
+            record = {
+                'name': name,
+                'wall_time': wall_time,
+                'peak_rss': peak_rss(),
+                'counters': dict(
+                    (key, value - counters.get(key, 0))
+                    for key, value in self.counters.items()
+                    if value != counters.get(key, 0))
+            }
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record['traced_memory'] = current
+                record['traced_peak'] = peak
+            self.stages.append(record)
+
+            self.message("took {0} seconds\n".format(wall_time))
+
+    def wrap(self, moab):
+        """Wrap a MOAB instance so that calls made through it are counted."""
+        return CountingMoab(moab, self)
+
+    def report(self):
+        return {
+            'wall_time': time.time() - self._start,
+            'peak_rss': peak_rss(),
+            'stages': self.stages,
+            'counters': self.counters
+        }
+
+    def write_report(self, output_file):
+        """Write the report next to output_file, along with the profile of
+        each stage when profiling. Returns the path of the report."""
+        path = report_path(output_file)
+        report = self.report()
+
+        if self.profiles:
+            root = os.path.splitext(path)[0]
+            report['profiles'] = []
+            for n, (name, profiler) in enumerate(self.profiles):
+                profile_path = "{0}.{1}-{2}.prof".format(
+                    root, n, re.sub(r'\W+', '_', name).strip('_').lower())
+                profiler.dump_stats(profile_path)
+                report['profiles'].append(profile_path)
+
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+        return path
+
+
+class CountingMoab(object):
+    """ Forwards every call to a MOAB instance, counting calls, created
+    elements and created meshsets on an Instrumentation.
+    """
+    def __init__(self, moab, instrumentation):
+        self._moab = moab
+        self._instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        attr = getattr(self._moab, name)
+        if not callable(attr):
+            return attr
+
+        instrumentation = self._instrumentation
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            instrumentation.count('moab_calls')
+            if name == 'create_elements':
+                instrumentation.count('elements', len(result))
+            elif name == 'create_element':
+                instrumentation.count('elements')
+            elif name == 'create_meshset':
+                instrumentation.count('meshsets')
+            return result
+
+        return call
@@ -0,0 +1,159 @@
+"""
+Readers of cell property files, such as the SPE10 porosity and permeability
+maps, backed by a binary cache.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def cache_path(path):
+    """Path of the .npy cache kept next to a property file."""
+    return path + '.npy'
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_property(path):
+    """Parse a text file of whitespace separated values into a float64
+    array, whatever the number of values per line."""
+    return np.fromfile(path, dtype='float64', sep=' ')
+
+
+def _cache_is_valid(path, stat, metadata_path):
+    try:
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+    except (IOError, OSError, ValueError):
+        return False
+
+    if metadata.get('size') != stat.st_size:
+        return False
+    if metadata.get('mtime') == stat.st_mtime:
+        return True
+
+    # Touched but maybe not changed: fall back to the content hash
+    if metadata.get('hash') != _file_hash(path):
+        return False
+
+    metadata['mtime'] = stat.st_mtime
+    _write_json(metadata_path, metadata)
+    return True
+
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as output:
+        json.dump(data, output)
+    os.rename(tmp_path, path)
+
+
+def _write_cache(path, stat, values):
+    npy_path = cache_path(path)
+    tmp_path = npy_path + '.tmp'
+    with open(tmp_path, 'wb') as output:
+        np.save(output, values)
+    os.rename(tmp_path, npy_path)
+
+    _write_json(npy_path + '.json', {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'hash': _file_hash(path)
+    })
+
+
+def check_size(source, values, size):
+    """Return values, or raise a ValueError naming their source (a path or
+    a description) unless they are size values. A None size is not
+    checked."""
+    if size is not None and values.size != size:
+        raise ValueError(
+            "{0} holds {1} values, where {2} are expected.".format(
+                source, values.size, size))
+    return values
+
+
+def read_property(path, cache=True, size=None):
+    """Read the values of a property file as a float64 array.
+
+    Parameters
+    ----------
+    path: String
+        Text file of whitespace separated values.
+    cache: Boolean
+        Keeps a binary copy of the values next to path, valid as long as the
+        size and modification time, or else the content hash, of path are
+        unchanged. Later reads memory-map the copy instead of parsing path.
+        Reading goes on uncached where the copy can not be written.
+    size: Integer, optional
+        Number of values path must hold. Parsing stops at the first token
+        that is not a number, so a file holding any other number of values
+        raises a ValueError, and is not cached.
+    """
+    if not cache:
+        return check_size(path, parse_property(path), size)
+
+    stat = os.stat(path)
+    npy_path = cache_path(path)
+    if (os.path.exists(npy_path) and
+            _cache_is_valid(path, stat, npy_path + '.json')):
+        return check_size(path, np.load(npy_path, mmap_mode='r'), size)
+
+    values = check_size(path, parse_property(path), size)
+    try:
+        _write_cache(path, stat, values)
+    except (IOError, OSError):
+        return values
+
+    return np.load(npy_path, mmap_mode='r')
+
+
+def read_window(path, model_size, origin, window, components=1, cache=True):
+    """Read the values of an ijk box of cells from a property file.
+
+    Parameters
+    ----------
+    path: String
+        Text file holding components blocks of values over the cells of the
+        whole model, x varying fastest.
+    model_size: List or array of integers
+        Number of cells of the model in x, y and z.
+    origin: List or array of integers
+        ijk index of the first cell of the box.
+    window: List or array of integers
+        Number of cells of the box in x, y and z.
+    components: Integer
+        Number of values per cell, stored one block after the other.
+    cache: Boolean
+        As in read_property. The box is then sliced from the memory-mapped
+        copy, reading only the pages that it covers.
+
+    Returns
+    -------
+    float64 array holding the components blocks of values of the box, x
+    varying fastest.
+    """
+    model_size = [int(n) for n in model_size]
+    origin = [int(i) for i in origin]
+    window = [int(n) for n in window]
+    values = read_property(path, cache,
+                           components * int(np.prod(model_size)))
+
+    if any(i < 0 or n < 1 or i + n > m
+           for i, n, m in zip(origin, window, model_size)):
+        raise ValueError(
+            "A {0} window at {1} does not fit in a {2} model.".format(
+                window, origin, model_size))
+
+    box = (slice(None),) + tuple(
+        slice(i, i + n) for i, n in zip(origin, window))[::-1]
+    values = values.reshape([components] + model_size[::-1])
+    return np.ascontiguousarray(values[box], dtype='float64').ravel()
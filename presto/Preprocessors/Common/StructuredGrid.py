@@ -0,0 +1,510 @@
+"""
+Index arithmetic shared by the structured preprocessors.
+
+Every routine here is dimension generic: sizes are given as one value per
+axis, ordered (x, y[, z]), and cells or vertices are numbered with x varying
+fastest, which is the order in which the preprocessors create them.
+"""
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import numpy as np
+
+
+# Corner offsets of a cell in the MOAB canonical ordering (MBQUAD, then the
+# top layer of a MBHEX).
+_QUAD_CORNERS = ((0, 0), (1, 0), (1, 1), (0, 1))
+
+# Directions of the sectors around a collocation point. The dual volume of a
+# sector spans the collocation points of a primal and of the primal at
+# (primal - sector).
+DUAL_SECTORS = {
+    2: ((-1, 1), (1, 1), (-1, -1), (1, -1)),
+    3: ((-1, 1, 1), (1, 1, 1), (-1, -1, 1), (1, -1, 1),
+        (-1, 1, -1), (1, 1, -1), (-1, -1, -1), (1, -1, -1))
+}
+
+
+def handles_array(entities):
+    """Return a range of MOAB entity handles as an uint64 array.
+
+    Contiguous ranges, which is what bulk creation returns on a fresh
+    instance, are expanded without touching each handle in Python.
+    """
+    n = len(entities)
+    if n == 0:
+        return np.empty(0, dtype='uint64')
+
+    first, last = int(entities[0]), int(entities[n - 1])
+    if last - first == n - 1:
+        return np.arange(first, last + 1, dtype='uint64')
+
+    return np.fromiter(entities, dtype='uint64', count=n)
+
+
+def axis_nodes(n, spacing):
+    """Vertex coordinates along one axis of a structured grid.
+
+    Parameters
+    ----------
+    n: Integer
+        Number of cells along the axis.
+    spacing: Float or array of floats
+        Either a constant cell size or the size of each of the n cells.
+    """
+    spacing = np.asarray(spacing, dtype='float64')
+    if spacing.ndim == 0:
+        return np.arange(n + 1, dtype='float64') * spacing
+
+    if len(spacing) != n:
+        raise ValueError("Expected {0} cell sizes, got {1}.".format(
+            n, len(spacing)))
+
+    nodes = np.empty(n + 1, dtype='float64')
+    nodes[0] = 0.0
+    np.cumsum(spacing, out=nodes[1:])
+    return nodes
+
+
+def vertex_coords(nodes):
+    """Coordinates of every vertex of a structured grid.
+
+    Parameters
+    ----------
+    nodes: List of arrays of floats
+        Vertex coordinates along each axis, as given by axis_nodes.
+
+    Returns
+    -------
+    A flat float64 array with the (x, y, z) coordinates of each vertex, x
+    varying fastest, ready to be handed to create_vertices. Missing axes
+    of 2-D grids get a zero coordinate.
+    """
+    ndim = len(nodes)
+    shape = tuple(len(axis) for axis in nodes[::-1])
+
+    coords = np.zeros(shape + (3,), dtype='float64')
+    for dim, axis in enumerate(nodes):
+        view = [np.newaxis] * ndim
+        view[ndim - 1 - dim] = slice(None)
+        coords[..., dim] = axis[tuple(view)]
+
+    return coords.reshape(-1)
+
+
+def cell_corners(ndim):
+    """Corner offsets (one row per corner) of a 2-D or 3-D cell."""
+    if ndim == 2:
+        return np.array(_QUAD_CORNERS)
+    if ndim == 3:
+        return np.array([c + (0,) for c in _QUAD_CORNERS] +
+                        [c + (1,) for c in _QUAD_CORNERS])
+    raise ValueError("Only 2-D and 3-D grids are supported.")
+
+
+def cell_vertex_ids(mesh_size):
+    """Vertex indices of every cell of a structured grid.
+
+    Parameters
+    ----------
+    mesh_size: List or array of integers
+        Number of cells along each axis.
+
+    Returns
+    -------
+    An (N, 2**ndim) int64 array with the connectivity of each cell, cells
+    ordered with x varying fastest.
+    """
+    mesh_size = np.asarray(mesh_size, dtype='int64')
+    ndim = len(mesh_size)
+
+    # Vertex strides along each axis.
+    strides = np.cumprod(np.concatenate(([1], mesh_size[:-1] + 1)))
+
+    base = _grid_sum([np.arange(n, dtype='int64') * stride
+                      for n, stride in zip(mesh_size, strides)])
+    offsets = cell_corners(ndim).dot(strides)
+
+    return base.reshape(-1, 1) + offsets
+
+
+def axis_primal_ids(mesh_size, coarse_ratio):
+    """Primal index of every fine cell along each axis.
+
+    Cells are grouped coarse_ratio at a time. A leftover group at the end
+    of an axis is merged into the previous primal when it is shorter than
+    half the axis.
+
+    Returns
+    -------
+    A list with one int32 array per axis.
+    """
+    primal_ids = []
+    for n, ratio in zip(mesh_size, coarse_ratio):
+        ids = np.arange(n, dtype='int32') // ratio
+
+        leftover = (n // ratio) * ratio
+        if 0 < n - leftover < n // 2:
+            ids[leftover:] = ids[-1] - 1
+
+        primal_ids.append(ids)
+
+    return primal_ids
+
+
+def coarse_dims(primal_ids):
+    """Number of primals along each axis."""
+    return [int(np.max(ids)) + 1 for ids in primal_ids]
+
+
+def grid_ijk(dims):
+    """(N, ndim) index of every cell of a grid, x varying fastest."""
+    ndim = len(dims)
+    return np.indices(dims[::-1]).reshape(ndim, -1)[::-1].T
+
+
+def cell_primal_ids(primal_ids):
+    """Linear id of the primal holding each fine cell.
+
+    Parameters
+    ----------
+    primal_ids: List of arrays of integers
+        Primal index of every fine cell along each axis, as computed by the
+        preprocessors' calculate_primal_ids.
+
+    Returns
+    -------
+    An (N,) int64 array, fine cells and primals both numbered with x varying
+    fastest.
+    """
+    dims = coarse_dims(primal_ids)
+    strides = np.cumprod([1] + dims[:-1])
+
+    return _grid_sum([np.asarray(ids, dtype='int64') * stride
+                      for ids, stride in zip(primal_ids, strides)]).ravel()
+
+
+def face_adjacency(dims):
+    """Face neighbours of every cell of a grid.
+
+    Parameters
+    ----------
+    dims: List or array of integers
+        Number of cells along each axis.
+
+    Returns
+    -------
+    An (N + 1,) offsets array and a neighbours array in CSR layout: the
+    linear ids of the neighbours of cell i are
+    neighbours[offsets[i]:offsets[i + 1]]. Neighbours are listed in
+    lexicographic order of their (i, j, k) shift, i.e. the -x, -y, -z, +z,
+    +y and +x neighbours.
+    """
+    dims = [int(n) for n in dims]
+    ndim = len(dims)
+    n_cells = int(np.prod(dims))
+    strides = np.cumprod([1] + dims[:-1])
+
+    ijk = grid_ijk(dims)
+    ids = np.arange(n_cells, dtype='int64')
+    shifts = ([(dim, -1) for dim in range(ndim)] +
+              [(dim, 1) for dim in reversed(range(ndim))])
+
+    neighbours = np.full((n_cells, len(shifts)), -1, dtype='int64')
+    for col, (dim, shift) in enumerate(shifts):
+        valid = ((ijk[:, dim] + shift >= 0) &
+                 (ijk[:, dim] + shift < dims[dim]))
+        neighbours[valid, col] = ids[valid] + shift * strides[dim]
+
+    has_neighbour = neighbours >= 0
+    offsets = np.zeros(n_cells + 1, dtype='int64')
+    np.cumsum(has_neighbour.sum(axis=1), out=offsets[1:])
+
+    return offsets, neighbours[has_neighbour]
+
+
+def primal_centroids(primals_ijk, coarse_ratio, dims=None, mesh_size=None):
+    """Fine ijk of the centroid (collocation point) of each primal.
+
+    Parameters
+    ----------
+    primals_ijk: Array of integers
+        (N, ndim) coarse index of each primal.
+    coarse_ratio: List or array of integers
+        Coarsening ratio along each axis.
+    dims, mesh_size: Lists or arrays of integers, optional
+        Number of primals and of fine cells along each axis. When given,
+        the centroids of primals on the boundary of the coarse grid are
+        moved onto the boundary of the fine grid, as the dual grid
+        requires.
+
+    Returns
+    -------
+    An (N, ndim) int64 array.
+    """
+    primals_ijk = np.asarray(primals_ijk, dtype='int64')
+    ratio = np.asarray(coarse_ratio, dtype='int64')[:primals_ijk.shape[1]]
+
+    centroids = primals_ijk * ratio + ratio // 2
+
+    if dims is not None:
+        last_primal = np.asarray(dims, dtype='int64') - 1
+        last_cell = np.asarray(mesh_size, dtype='int64') - 1
+        centroids = np.where(primals_ijk == last_primal, last_cell, centroids)
+        centroids[primals_ijk == 0] = 0
+
+    return centroids
+
+
+def axis_centroids(dims, coarse_ratio, mesh_size):
+    """Fine index of the collocation points along each axis.
+
+    Returns
+    -------
+    A list with one int64 array per axis, holding the centroid coordinate
+    of every primal row, column and layer, as primal_centroids computes it.
+    """
+    return [primal_centroids(
+        np.arange(n).reshape(-1, 1), [ratio], [n], [size])[:, 0]
+        for n, ratio, size in zip(dims, coarse_ratio, mesh_size)]
+
+
+def dual_volume_boxes(primals_ijk, axis_centroids):
+    """Bounding boxes of the dual volumes around each collocation point.
+
+    Parameters
+    ----------
+    primals_ijk: Array of integers
+        (N, ndim) coarse index of each primal.
+    axis_centroids: List of arrays of integers
+        Fine index of the collocation points along each axis, i.e. the
+        centroid coordinate of every primal row, column and layer.
+
+    Returns
+    -------
+    A list holding, for each primal, the (min_coords, max_coords) tuples of
+    the dual volumes sharing its collocation point, max_coords exclusive.
+    Only integers are involved, so this can be computed anywhere, away from
+    the MOAB instance.
+    """
+    primals_ijk = np.asarray(primals_ijk, dtype='int64')
+    ndim = primals_ijk.shape[1]
+    dims = np.array([len(c) for c in axis_centroids])
+
+    boxes = [[] for _ in range(len(primals_ijk))]
+    for sector in DUAL_SECTORS[ndim]:
+        adj_ijk = primals_ijk - sector
+        valid = np.all((adj_ijk >= 0) & (adj_ijk < dims), axis=1)
+        adj_ijk = np.clip(adj_ijk, 0, dims - 1)
+
+        centroid = np.column_stack(
+            [c[primals_ijk[:, d]] for d, c in enumerate(axis_centroids)])
+        adj_centroid = np.column_stack(
+            [c[adj_ijk[:, d]] for d, c in enumerate(axis_centroids)])
+        min_coords = np.minimum(centroid, adj_centroid).tolist()
+        max_coords = (np.maximum(centroid, adj_centroid) + 1).tolist()
+
+        for n in np.flatnonzero(valid):
+            boxes[n].append((tuple(min_coords[n]), tuple(max_coords[n])))
+
+    return boxes
+
+
+def group_by(ids, n):
+    """Bucket positions by id.
+
+    Returns the positions sorted by id (stable) and an (n + 1,) offsets
+    array, so that the positions holding id i are
+    order[offsets[i]:offsets[i + 1]].
+    """
+    order = np.argsort(ids, kind='mergesort')
+    offsets = np.zeros(n + 1, dtype='int64')
+    np.cumsum(np.bincount(ids, minlength=n), out=offsets[1:])
+
+    return order, offsets
+
+
+def _grid_sum(values):
+    """Outer sum of per-axis values, shaped (..., ny, nx)."""
+    ndim = len(values)
+    total = np.zeros([len(v) for v in values[::-1]], dtype='int64')
+    for dim, v in enumerate(values):
+        shape = [1] * ndim
+        shape[ndim - 1 - dim] = len(v)
+        total += v.reshape(shape)
+
+    return total
+
+
+class GridMap(Mapping):
+    """Read-only mapping from (i, j[, k]) tuples to the cells of an array.
+
+    Parameters
+    ----------
+    array: Array
+        Array indexed [k, j, i]; any trailing axes past the first ndim hold
+        the value of each cell.
+    ndim: Integer, optional
+        Number of grid axes, all of the array's axes by default.
+    origin: List or array of integers, optional
+        (i, j[, k]) key of the array's first cell, when the array only
+        holds a window of a larger grid.
+    """
+    def __init__(self, array, ndim=None, origin=None):
+        self.array = array
+        self.ndim = array.ndim if ndim is None else ndim
+        self.dims = array.shape[:self.ndim][::-1]
+        self.origin = (np.zeros(self.ndim, dtype='int64') if origin is None
+                       else np.asarray(origin, dtype='int64'))
+
+    def __getitem__(self, ijk):
+        return self.array[self._local(ijk)[::-1]]
+
+    def __iter__(self):
+        for ijk in (grid_ijk(self.dims) + self.origin).tolist():
+            yield tuple(ijk)
+
+    def __len__(self):
+        return int(np.prod(self.dims))
+
+    def _local(self, ijk):
+        ijk = tuple(ijk)
+        local = tuple(c - o for c, o in zip(ijk, self.origin.tolist()))
+        if len(ijk) != self.ndim or not all(
+                0 <= c < n for c, n in zip(local, self.dims)):
+            raise KeyError(ijk)
+
+        return local
+
+
+class AdjacencyMap(GridMap):
+    """Read-only mapping from (i, j[, k]) tuples to the list of (i, j[, k])
+    tuples of their neighbours, stored in CSR layout.
+
+    Parameters
+    ----------
+    offsets, neighbours: Arrays of integers
+        Adjacency in CSR layout, as returned by face_adjacency.
+    dims: List or array of integers
+        Number of cells along each axis.
+    origin: List or array of integers, optional
+        (i, j[, k]) key of the first cell, as in GridMap.
+    """
+    def __init__(self, offsets, neighbours, dims, origin=None):
+        self.offsets = offsets
+        self.neighbours = neighbours
+        super(AdjacencyMap, self).__init__(
+            np.arange(len(offsets) - 1).reshape(tuple(dims)[::-1]),
+            origin=origin)
+
+    def __getitem__(self, ijk):
+        cell = super(AdjacencyMap, self).__getitem__(ijk)
+        neighbours = self.neighbours[
+            self.offsets[cell]:self.offsets[cell + 1]]
+
+        return [tuple(adj_ijk) for adj_ijk in
+                (np.column_stack(np.unravel_index(
+                    neighbours, self.array.shape)[::-1]) +
+                 self.origin).tolist()]
+
+
+class StructuredGrid(object):
+    """Closed-form topology and geometry of a structured grid.
+
+    Cells are numbered with x varying fastest, which is the order in which
+    they are created. When their MOAB handles are consecutive, as on a
+    fresh instance, only the first one is kept and handles are computed;
+    otherwise the (increasing) handles are kept in an array. Every query
+    takes an array of linear cell indices and answers for all of them at
+    once.
+
+    Parameters
+    ----------
+    mesh_size: List or array of integers
+        Number of cells along each axis.
+    block_size: List of floats or of arrays of floats
+        Cell size along each axis, either constant or given for each cell,
+        as taken by axis_nodes.
+    handles: Integer or range of handles, optional
+        MOAB handle of the first cell, or the handles of every cell.
+    """
+    def __init__(self, mesh_size, block_size, handles=0):
+        self.mesh_size = [int(n) for n in mesh_size]
+        self.ndim = len(self.mesh_size)
+        self.n_cells = int(np.prod(self.mesh_size))
+        self.strides = np.cumprod([1] + self.mesh_size[:-1]).astype('int64')
+
+        self.start_handle = np.uint64(0)
+        self.handles = None  # Only set when handles are not consecutive
+        if not hasattr(handles, '__len__'):
+            self.start_handle = np.uint64(handles)
+        elif len(handles):
+            handles = handles_array(handles)
+            if int(handles[-1]) - int(handles[0]) == len(handles) - 1:
+                self.start_handle = handles[0]
+            else:
+                self.handles = handles
+
+        self.nodes = [axis_nodes(n, size)
+                      for n, size in zip(self.mesh_size, block_size)]
+
+    def index(self, ijk):
+        """Linear index of (..., ndim) ijk positions."""
+        return np.asarray(ijk, dtype='int64').dot(self.strides)
+
+    def ijk(self, index):
+        """(..., ndim) ijk position of linear indices."""
+        index = np.asarray(index, dtype='int64')
+        return np.stack([(index // stride) % n for n, stride in
+                         zip(self.mesh_size, self.strides)], axis=-1)
+
+    def handle(self, index):
+        """MOAB handle of linear indices."""
+        if self.handles is not None:
+            return self.handles[index]
+        return np.asarray(index, dtype='uint64') + self.start_handle
+
+    def box_index(self, min_coords, max_coords):
+        """Linear index of the cells in the box [min_coords, max_coords),
+        x varying fastest."""
+        return _grid_sum([np.arange(lo, hi, dtype='int64') * stride
+                          for lo, hi, stride in zip(
+                              min_coords, max_coords, self.strides)]).ravel()
+
+    def neighbours(self, index):
+        """Face neighbours of cells.
+
+        Returns
+        -------
+        A (..., 2 * ndim) int64 array with the linear index of the -x, +x,
+        -y, +y[, -z, +z] neighbours of each cell, -1 past the boundary.
+        Column c holds the neighbour along axis c // 2.
+        """
+        index = np.asarray(index, dtype='int64')
+        ijk = self.ijk(index)
+
+        neighbours = np.empty(index.shape + (2 * self.ndim,), dtype='int64')
+        for dim, (n, stride) in enumerate(zip(self.mesh_size, self.strides)):
+            neighbours[..., 2 * dim] = np.where(
+                ijk[..., dim] > 0, index - stride, -1)
+            neighbours[..., 2 * dim + 1] = np.where(
+                ijk[..., dim] < n - 1, index + stride, -1)
+
+        return neighbours
+
+    def cell_sizes(self, index):
+        """(..., ndim) size of cells along each axis."""
+        ijk = self.ijk(index)
+        return np.stack([np.diff(nodes)[ijk[..., dim]]
+                         for dim, nodes in enumerate(self.nodes)], axis=-1)
+
+    def volumes(self, index):
+        """(...) volume of cells (their area on 2-D grids)."""
+        return np.prod(self.cell_sizes(index), axis=-1)
+
+    def half_distances(self, index):
+        """(..., ndim) distance from the centre of cells to their faces
+        normal to each axis."""
+        return self.cell_sizes(index) / 2
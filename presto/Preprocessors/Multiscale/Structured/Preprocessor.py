@@ -1,6 +1,11 @@
-import time
+import os
+
+import numpy as np
+from pymoab import core
+from pymoab import types
 
 from .StructuredMultiscaleMesh import StructuredMultiscaleMesh
+from ...Common.Instrumentation import Instrumentation
 
 
 class Preprocessor(object):
@@ -16,31 +21,89 @@ class Preprocessor(object):
         self.coarse_ratio = self.structured_configs['coarse-ratio']
         self.mesh_size = self.structured_configs['mesh-size']
         self.block_size = self.structured_configs['block-size']
+        self.slab_layers = self.structured_configs.get('slab-layers', 0)
 
+        self.instrumentation = Instrumentation.from_configs(self.configs)
         self.smm = StructuredMultiscaleMesh(
-            self.coarse_ratio, self.mesh_size, self.block_size)
+            self.coarse_ratio, self.mesh_size, self.block_size,
+            self.instrumentation)
 
     def run(self, moab):
-        self.smm.set_moab(moab)
-
+        output_file = self.configs['General']['output-file']
         self.smm.calculate_primal_ids()
+
+        if not self.slab_layers:
+            self.smm.set_moab(self.instrumentation.wrap(moab))
+            self.generate_mesh()
+            self.instrumentation.write_report(output_file)
+            return
+
+        # Generate and write the mesh one slab of primal layers at a time,
+        # each slab to its own file, so that only one slab is held in memory.
+        # The pipeline's own instance, written to the output file, indexes
+        # the parts.
+        output_root, output_ext = os.path.splitext(output_file)
+        for n, layers in enumerate(self.smm.slabs(self.slab_layers)):
+            stage_prefix = "Slab {0} (primal layers {1} to {2}): ".format(
+                n, layers[0], layers[1] - 1)
+            self.smm.set_slab(layers)
+
+            slab_moab = core.Core()
+            self.smm.set_moab(self.instrumentation.wrap(slab_moab))
+            self.generate_mesh(stage_prefix)
+
+            with self.instrumentation.stage(stage_prefix + "Writing"):
+                slab_moab.write_file(
+                    "{0}_slab{1}{2}".format(output_root, n, output_ext))
+            self.index_slab(moab, n)
+
+        self.instrumentation.write_report(output_file)
+
+    def index_slab(self, moab, n):
+        """
+        Add to moab a meshset standing for the n-th slab part file,
+        <output>_slab<n>.h5m, tagged with its SLAB_PART number and with the
+        (first, last + 1) ranges of the SLAB_PRIMAL_LAYERS it owns and of
+        the SLAB_CELL_LAYERS it holds, along the last axis.
+
+        The fine cells past its own primal layers, the vertices only they
+        use, the partial primals they belong to and the dual entities whose
+        first cell is past them carry GHOST = 1: the neighbouring part owns
+        them and writes them untagged. Loading every part and dropping the
+        GHOST entities leaves each cell, primal and dual entity once. The
+        vertex planes shared by the owned cells of two parts are written
+        with both, and are matched by their coordinates.
+        """
+        part_tag = moab.tag_get_handle(
+            "SLAB_PART", 1, types.MB_TYPE_INTEGER, types.MB_TAG_SPARSE, True)
+        primal_layers_tag = moab.tag_get_handle(
+            "SLAB_PRIMAL_LAYERS", 2, types.MB_TYPE_INTEGER,
+            types.MB_TAG_SPARSE, True)
+        cell_layers_tag = moab.tag_get_handle(
+            "SLAB_CELL_LAYERS", 2, types.MB_TYPE_INTEGER,
+            types.MB_TAG_SPARSE, True)
+
+        part = moab.create_meshset()
+        moab.tag_set_data(part_tag, part, n)
+        moab.tag_set_data(primal_layers_tag, part,
+                          np.array(self.smm.primal_layers, dtype='int32'))
+        moab.tag_set_data(cell_layers_tag, part,
+                          np.array(self.smm.cell_layers, dtype='int32'))
+
+    def generate_mesh(self, stage_prefix=""):
         self.smm.create_tags()
 
-        print("Creating fine vertices...")
-        t0 = time.time()
-        self.smm.create_fine_vertices()
-        print("took {0}\n".format(time.time()-t0))
+        with self.instrumentation.stage(
+                stage_prefix + "Creating fine vertices"):
+            self.smm.create_fine_vertices()
 
-        print("Creating fine blocks and primal...")
-        t0 = time.time()
-        self.smm.create_fine_blocks_and_primal()
-        print("took {0}\n".format(time.time()-t0))
+        with self.instrumentation.stage(
+                stage_prefix + "Creating fine blocks and primal"):
+            self.smm.create_fine_blocks_and_primal()
 
-        print("Generating dual...")
-        t0 = time.time()
-        self.smm.generate_dual()
-        self.smm.store_primal_adj()
-        print("took {0}\n".format(time.time()-t0))
+        with self.instrumentation.stage(stage_prefix + "Generating dual"):
+            self.smm.generate_dual()
+            self.smm.store_primal_adj()
 
     @property
     def structured_configs(self):
@@ -92,3 +155,16 @@ class Preprocessor(object):
                              "file.")
 
         self._block_size = [int(v) for v in values]
+
+    @property
+    def slab_layers(self):
+        return self._slab_layers
+
+    @slab_layers.setter
+    def slab_layers(self, value):
+        slab_layers = int(value)
+        if slab_layers < 0:
+            raise ValueError("The slab-layers option under the [StructuredMS] "
+                             "section must be a non-negative integer.")
+
+        self._slab_layers = slab_layers
@@ -1,89 +1,122 @@
 import numpy as np
-from pymoab import core
 from pymoab import types
-from pymoab import topo_util
+
+from ...Common.StructuredGrid import (
+    axis_nodes, vertex_coords, handles_array, cell_vertex_ids,
+    axis_primal_ids, coarse_dims, cell_primal_ids, face_adjacency, grid_ijk,
+    group_by, primal_centroids, axis_centroids, dual_volume_boxes, GridMap,
+    AdjacencyMap, StructuredGrid)
+from ...Common.Instrumentation import Instrumentation
+
+
+ELEM_TYPES = {2: types.MBQUAD, 3: types.MBHEX}
 
 
 class StructuredMultiscaleMesh:
     """ Defines a structured multiscale mesh representation.
 
+    The mesh dimension follows the number of values given for each parameter:
+    three values build hexahedra, two values build quadrilaterals.
+
     Parameters
     ----------
     coarse_ratio: List or array of integers
-        List or array containing three values indicating the coarsening ratio
-        of the mesh in x, y and z.
+        List or array containing one value per axis indicating the
+        coarsening ratio of the mesh in x, y and, in 3-D, z.
     mesh_size: List or array of integers
-        List or array containing three values indicating the mesh size
-        (number of fine elements) of the mesh in x, y and z.
-    block_size List o array of floats
-        List or array containing three values indicating the constant
-        increments of vertex coordinates in x, y and z.
+        List or array containing one value per axis indicating the mesh size
+        (number of fine elements) of the mesh in x, y and, in 3-D, z.
+    block_size: List or array of floats
+        List or array containing one value per axis indicating the constant
+        increments of vertex coordinates in x, y and, in 3-D, z.
+    instrumentation: Instrumentation, optional
+        Receives the progress of the mesh generation.
     """
-    def __init__(self, coarse_ratio, mesh_size, block_size):
+    def __init__(self, coarse_ratio, mesh_size, block_size,
+                 instrumentation=None):
         self.coarse_ratio = coarse_ratio
         self.mesh_size = mesh_size
         self.block_size = block_size
+        self.instrumentation = instrumentation or Instrumentation()
 
         self.verts = None  # Array containing MOAB vertex entities
-        self.elems = []  # List containing MOAB volume entities
-
-        self.primals = {}  # Mapping from tuples (idx, idy, idz) to Meshsets
-        self.primal_ids = []
+        self.grid = None  # Index arithmetic over the fine MOAB elements
+        self.elem_type = ELEM_TYPES[len(mesh_size)]
 
+        # Mappings from tuples (idx, idy, idz) to primal Meshsets, collocation
+        # point ijk and adjacent (idx, idy, idz) tuples, backed by arrays
+        self.primals = {}
         self.primal_centroid_ijk = {}
         self.primal_adj = {}
 
-        # MOAB boilerplate
-        # self.mb = core.Core()
-        # self.root_set = self.mb.get_root_set()
-        # self.mesh_topo_util = topo_util.MeshTopoUtil(self.mb)
+        self.primal_ids = []  # Primal index of fine cells along each axis
+
+        # Range of primal layers (along the last axis) being generated, the
+        # range of fine cell layers they need and the range of those they own
+        self.primal_layers = None
+        self.cell_layers = None
+        self.owned_cell_layers = None
+
+        # Mapping from dual entity boxes to Meshsets, and the ones another
+        # slab owns
+        self.dual_sets = {}
+        self.ghost_dual_sets = []
 
     def set_moab(self, moab):
         self.mb = moab
 
     def calculate_primal_ids(self):
-        for dim in range(0, 3):
-            self.primal_ids.append(
-                [i // (self.coarse_ratio[dim]) for i in range(
-                    self.mesh_size[dim])])
-
-        new_primal = []
-        for dim in range(0, 3):
-            new_primal.append(
-                self.primal_ids[dim][(
-                    self.mesh_size[dim] // self.coarse_ratio[dim]) *
-                                     self.coarse_ratio[dim]:])
-
-            if len(new_primal[dim]) < (self.mesh_size[dim] // 2):
-                new_primal[dim] = np.repeat(
-                    max(self.primal_ids[dim])-1, len(new_primal[dim])).tolist()
-                self.primal_ids[dim] = (
-                    self.primal_ids[dim]
-                    [:self.mesh_size[dim] //
-                     self.coarse_ratio[dim] *
-                     self.coarse_ratio[dim]]+new_primal[dim])
+        self.primal_ids = axis_primal_ids(self.mesh_size, self.coarse_ratio)
+        self.set_slab((0, coarse_dims(self.primal_ids)[-1]))
+
+    def slabs(self, layers):
+        """
+        Split the primal layers along the last axis in slabs of at most
+        `layers` layers, given as (first, last + 1) ranges.
+        """
+        n_layers = coarse_dims(self.primal_ids)[-1]
+        return [(first, min(first + layers, n_layers))
+                for first in range(0, n_layers, layers)]
+
+    def set_slab(self, primal_layers):
+        """
+        Restrict the mesh to the primals of a range of layers along the last
+        axis and drop the entities of the previous slab. Fine cells are
+        created up to the collocation points of the neighbouring layers, so
+        that the dual volumes around the slab's collocation points are
+        complete.
+        """
+        first, last = primal_layers
+        centroids = axis_centroids(coarse_dims(self.primal_ids),
+                                   self.coarse_ratio, self.mesh_size)[-1]
+
+        self.primal_layers = (first, last)
+        self.cell_layers = (
+            int(centroids[first - 1]) if first > 0 else 0,
+            int(centroids[last]) + 1 if last < len(centroids)
+            else self.mesh_size[-1])
+        owned = np.flatnonzero((self.primal_ids[-1] >= first) &
+                               (self.primal_ids[-1] < last))
+        self.owned_cell_layers = (int(owned[0]), int(owned[-1]) + 1)
+
+        self.verts = None
+        self.grid = None
+        self.primals = {}
+        self.primal_centroid_ijk = {}
+        self.primal_adj = {}
+        self.dual_sets = {}
+        self.ghost_dual_sets = []
 
     def create_fine_vertices(self):
-        max_mesh_size = max(
-            self.mesh_size[2]*self.block_size[2],
-            self.mesh_size[1]*self.block_size[1],
-            self.mesh_size[0]*self.block_size[0])
-
-        coords = np.array([(i, j, k)
-                           for k in (
-                               np.arange(
-                                   self.mesh_size[2]+1, dtype='float64') *
-                               self.block_size[2]/max_mesh_size)
-                           for j in (
-                               np.arange(
-                                   self.mesh_size[1]+1, dtype='float64') *
-                               self.block_size[1]/max_mesh_size)
-                           for i in (
-                               np.arange(
-                                   self.mesh_size[0]+1, dtype='float64') *
-                               self.block_size[0]/max_mesh_size)
-                           ], dtype='float64')
-        self.verts = self.mb.create_vertices(coords.flatten())
+        nodes = [axis_nodes(n, size)
+                 for n, size in zip(self.mesh_size, self.block_size)]
+        max_mesh_size = max(axis[-1] for axis in nodes)
+
+        first, last = self.cell_layers
+        nodes[-1] = nodes[-1][first:last + 1]
+
+        self.verts = self.mb.create_vertices(
+            vertex_coords([axis / max_mesh_size for axis in nodes]))
 
     def create_tags(self):
         self.gid_tag = self.mb.tag_get_handle(
@@ -104,388 +137,213 @@ class StructuredMultiscaleMesh:
             "COLLOCATION_POINT", 1, types.MB_TYPE_HANDLE,
             types.MB_TAG_SPARSE, True)
 
-    def _create_hexa(self, i, j, k):
-        # TODO: Refactor this
-        hexa = [self.verts[(i)+(j*(self.mesh_size[0]+1))+(k*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i, j, k)
-                self.verts[(i+1)+(j*(self.mesh_size[0]+1))+(k*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i+1, j, k)
-                self.verts[(i+1)+(j+1)*(self.mesh_size[0])+(j+1)+(k*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i+1, j+1, k)
-                self.verts[(i)+(j+1)*(self.mesh_size[0])+(j+1)+(k*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i, j+1, k)
+        self.primal_centroid_tag = self.mb.tag_get_handle(
+            "PRIMAL_CENTROID", len(self.mesh_size), types.MB_TYPE_INTEGER,
+            types.MB_TAG_DENSE, True)
 
-                self.verts[(i)+(j*(self.mesh_size[0]+1))+((k+1)*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i, j, k+1)
-                self.verts[(i+1)+(j*(self.mesh_size[0]+1))+((k+1)*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i+1, j, k+1)
-                self.verts[(i+1)+(j+1)*(self.mesh_size[0])+(j+1)+((k+1)*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))],  # (i+1, j+1, k+1)
-                self.verts[(i)+(j+1)*(self.mesh_size[0])+(j+1)+((k+1)*((self.mesh_size[0]+1)*(self.mesh_size[1]+1)))]]  # (i, j+1, k+1)
-
-        return hexa
+        # Set to 1 on the entities of a slab that another slab owns
+        self.ghost_tag = self.mb.tag_get_handle(
+            "GHOST", 1, types.MB_TYPE_INTEGER, types.MB_TAG_SPARSE, True)
 
     def create_fine_blocks_and_primal(self):
-        cur_id = 0
-
-        # Create fine grid
-        for k, idz in zip(range(self.mesh_size[2]),
-                          self.primal_ids[2]):
-
-            print("{0} / {1}".format(k, self.mesh_size[2]))
-
-            for j, idy in zip(range(self.mesh_size[1]),
-                              self.primal_ids[1]):
-
-                for i, idx in zip(range(self.mesh_size[0]),
-                                  self.primal_ids[0]):
-
-                    hexa = self._create_hexa(i, j, k)
-                    el = self.mb.create_element(types.MBHEX, hexa)
-
-                    self.mb.tag_set_data(self.gid_tag, el, cur_id)
-                    cur_id += 1
+        first, last = self.cell_layers
+        slab_size = list(self.mesh_size[:-1]) + [last - first]
+
+        verts = handles_array(self.verts)
+        elems = handles_array(self.mb.create_elements(
+            self.elem_type, verts[cell_vertex_ids(slab_size)]))
+
+        first_elem = first * int(np.prod(self.mesh_size[:-1]))
+        self.mb.tag_set_data(
+            self.gid_tag, elems,
+            np.arange(first_elem, first_elem + len(elems), dtype='int32'))
+        self.grid = StructuredGrid(slab_size, self.block_size, elems)
+
+        # Create primal coarse grid, for every primal layer the slab touches
+        dims = coarse_dims(self.primal_ids)
+        slab_primal_ids = (list(self.primal_ids[:-1]) +
+                           [self.primal_ids[-1][first:last]])
+        first_layer = int(slab_primal_ids[-1][0])
+        slab_dims = dims[:-1] + [int(slab_primal_ids[-1][-1]) + 1 -
+                                 first_layer]
+
+        first_primal = first_layer * int(np.prod(dims[:-1]))
+        n_primals = int(np.prod(slab_dims))
+        elems_primal_id = cell_primal_ids(slab_primal_ids) - first_primal
+        order, offsets = group_by(elems_primal_id, n_primals)
+
+        primals = np.array([self.mb.create_meshset()
+                            for _ in range(n_primals)], dtype='uint64')
+        for primal, start, end in zip(primals, offsets[:-1], offsets[1:]):
+            self.mb.add_entities(primal, elems[order[start:end]])
+
+        self.mb.tag_set_data(
+            self.fine_to_primal_tag, elems, primals[elems_primal_id])
+        self.mb.tag_set_data(
+            self.primal_id_tag, primals,
+            np.arange(first_primal, first_primal + n_primals, dtype='int32'))
+
+        self.primals = GridMap(primals.reshape(slab_dims[::-1]),
+                               origin=[0] * (len(dims) - 1) + [first_layer])
+
+        self._tag_ghosts(verts, elems)
+
+    def _tag_ghosts(self, verts, elems):
+        """
+        Tag the fine cells and primals that the slab only holds to complete
+        its dual volumes, and the vertices only they use. Each of them is
+        owned, and written untagged, by a neighbouring slab.
+        """
+        first, last = self.cell_layers
+        owned_first, owned_last = self.owned_cell_layers
+        layer_size = int(np.prod(self.mesh_size[:-1]))
+
+        elem_layers = np.arange(first, last).repeat(layer_size)
+        ghost_elems = elems[(elem_layers < owned_first) |
+                            (elem_layers >= owned_last)]
+
+        # The vertex plane shared by the owned cells of two slabs is held by
+        # both
+        vert_layers = np.arange(first, last + 1).repeat(
+            int(np.prod([n + 1 for n in self.mesh_size[:-1]])))
+        ghost_verts = verts[(vert_layers < owned_first) |
+                            (vert_layers > owned_last)]
+
+        owned = self._owned_primals()
+        primals = self.primals.array.ravel()
+        ghost_primals = np.concatenate((primals[:owned.start],
+                                        primals[owned.stop:]))
+
+        self._tag_ghost(np.concatenate((ghost_verts, ghost_elems,
+                                        ghost_primals)))
+
+    def _tag_ghost(self, entities):
+        if len(entities):
+            self.mb.tag_set_data(self.ghost_tag, entities,
+                                 np.ones(len(entities), dtype='int32'))
 
-                    self.elems.append(el)
-                    # Create primal coarse grid
-                    try:
-                        primal = self.primals[(idx, idy, idz)]
-                        self.mb.add_entities(primal, [el])
-                        self.mb.tag_set_data(
-                            self.fine_to_primal_tag, el, primal)
-                    except KeyError:
-                        primal = self.mb.create_meshset()
-                        self.primals[(idx, idy, idz)] = primal
-                        self.mb.add_entities(primal, [el])
-                        self.mb.tag_set_data(
-                            self.fine_to_primal_tag, el, primal)
+    def store_primal_adj(self):
+        owned = self._owned_primals()
+        offsets, neighbours = face_adjacency(self.primals.dims)
 
-        primal_id = 0
-        for primal in self.primals.values():
-            self.mb.tag_set_data(self.primal_id_tag, primal, primal_id)
-            primal_id += 1
+        primals = self.primals.array.ravel()
+        adjs = np.array([self.mb.create_meshset()
+                         for _ in primals[owned]], dtype='uint64')
 
-    def store_primal_adj(self):
-        min_coarse_ids = np.array([0, 0, 0])
-        max_coarse_ids = np.array([max(self.primal_ids[0]),
-                                   max(self.primal_ids[1]),
-                                   max(self.primal_ids[2])])
+        for adj, start, end in zip(adjs,
+                                   offsets[owned.start:owned.stop],
+                                   offsets[owned.start + 1:owned.stop + 1]):
+            self.mb.add_entities(adj, primals[neighbours[start:end]])
 
-        for primal_id, primal in self.primals.items():
-            adj = self.mb.create_meshset()
-            adj_ids = []
+        self.mb.tag_set_data(self.primal_adj_tag, primals[owned], adjs)
+        self.primal_adj = AdjacencyMap(
+            offsets, neighbours, self.primals.dims, self.primals.origin)
 
-            for i in np.arange(-1, 2):
-                for j in np.arange(-1, 2):
-                    for k in np.arange(-1, 2):
-                        coord_inc = np.array([i, j, k])
-                        adj_id = primal_id + coord_inc
-                        if any(adj_id != primal_id) and \
-                           (sum(coord_inc == [0, 0, 0]) == 2) and \
-                           all(adj_id >= min_coarse_ids) and \
-                           all(adj_id <= max_coarse_ids):
+    def _owned_primals(self):
+        """
+        Slice of self.primals.array.ravel() holding the primals of the slab,
+        leaving out the ones only touched by its fine cells.
+        """
+        layer_size = int(np.prod(self.primals.dims[:-1]))
+        first, last = np.array(self.primal_layers) - self.primals.origin[-1]
+        return slice(int(first) * layer_size, int(last) * layer_size)
 
-                            self.mb.add_entities(
-                                adj, [self.primals[tuple(adj_id)]])
-                            adj_ids.append(tuple(adj_id))
+    def _primal_centroid(self, setid):
+        return primal_centroids(np.atleast_2d(setid), self.coarse_ratio)[0]
 
-            self.mb.tag_set_data(self.primal_adj_tag, primal, adj)
+    def _get_elem_by_ijk(self, ijk):
+        ijk = list(ijk)
+        ijk[-1] -= self.cell_layers[0]
+        return self.grid.handle(self.grid.index(ijk))
 
-            self.primal_adj[primal_id] = adj_ids
+    def _get_elems_in_box(self, min_coords, max_coords):
+        min_coords, max_coords = list(min_coords), list(max_coords)
+        min_coords[-1] -= self.cell_layers[0]
+        max_coords[-1] -= self.cell_layers[0]
+        return self.grid.handle(self.grid.box_index(min_coords, max_coords))
 
-    def _primal_centroid(self, setid):
-        coarse_sums = np.array(
-            [[0, 0, 0],
-             [0, 0, 1],
-             [0, 1, 0],
-             [0, 1, 1],
-             [1, 0, 0],
-             [1, 0, 1],
-             [1, 1, 0],
-             [1, 1, 1]]
-        )
-        primal_centroid = (
-            (np.asarray(setid) + coarse_sums[0]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[1]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[2]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[3]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[4]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[5]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[6]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[7]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]))
-
-        primal_centroid = primal_centroid // 8
-        return primal_centroid
-
-    def _get_block_by_ijk(self, i, j, k, n_i, n_j):
+    def _generate_dual_entity(self, min_coords, max_coords, free_dims):
         """
-        Track down the block from its (i,j,k) position.
+        Get the meshset of the fine elements in a box, with the lower
+        dimensional entities on the box boundary (faces of a volume, edges of
+        a face and vertices of an edge) as its children. Each box is only
+        built once; neighbouring dual volumes share their faces, edges and
+        vertices.
         """
-        block = (k)*n_i*n_j+((i)+(j)*n_i)
-        return block
-
-    def _get_elem_by_ijk(self, ijk):
-        block_id = self._get_block_by_ijk(
-            ijk[0], ijk[1], ijk[2], self.mesh_size[0], self.mesh_size[1])
-        elem = self.elems[block_id]
-        return elem
-
-    def _generate_sector_bounding_box(self, primal_id, sector):
-        bbox = []
-
-        for sector_primal in sector:
-            try:
-                bbox.append(
-                    self.primal_centroid_ijk[tuple(primal_id - sector_primal)])
-            except KeyError:
-                pass
-
-        return np.array(bbox)
-
-    def _get_bbox_limit_coords(self, bbox):
-        # Max coords is +1 so that it's possible to do a
-        # np.arange(min_coords, max_coords) directly and INCLUDE the last coord
-        max_coords = np.array(
-            [bbox[:, 0].max(), bbox[:, 1].max(), bbox[:, 2].max()]) + 1
-        min_coords = np.array(
-            [bbox[:, 0].min(), bbox[:, 1].min(), bbox[:, 2].min()])
-
-        return [max_coords, min_coords]
-
-    def _generate_dual_faces(self, bbox):
-        max_coords, min_coords = self._get_bbox_limit_coords(bbox)
-
-        faces_sets = []
-
-        for idx in (min_coords[0], max_coords[0]-1):
-            face_set = self.mb.create_meshset()
-            faces_sets.append(face_set)
-
-            for idy in np.arange(min_coords[1], max_coords[1]):
-                for idz in np.arange(min_coords[2], max_coords[2]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(face_set, [elem])
-
-            # Generate edges
-            for idy in (min_coords[1], max_coords[1]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idz in np.arange(min_coords[2], max_coords[2]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idz in (min_coords[2], max_coords[2]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-            for idz in (min_coords[2], max_coords[2]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idy in np.arange(min_coords[1], max_coords[1]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idy in (min_coords[1], max_coords[1]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-        for idy in (min_coords[1], max_coords[1]-1):
-            face_set = self.mb.create_meshset()
-            faces_sets.append(face_set)
-
-            for idx in np.arange(min_coords[0], max_coords[0]):
-                for idz in np.arange(min_coords[2], max_coords[2]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(face_set, [elem])
-
-            # Generate edges
-            for idx in (min_coords[0], max_coords[0]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idz in np.arange(min_coords[2], max_coords[2]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idz in (min_coords[2], max_coords[2]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-            for idz in (min_coords[2], max_coords[2]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idx in np.arange(min_coords[0], max_coords[0]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idx in (min_coords[0], max_coords[0]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-        for idz in (min_coords[2], max_coords[2]-1):
-            face_set = self.mb.create_meshset()
-            faces_sets.append(face_set)
-
-            for idx in np.arange(min_coords[0], max_coords[0]):
-                for idy in np.arange(min_coords[1], max_coords[1]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(face_set, [elem])
-
-            # Generate edges
-            for idx in (min_coords[0], max_coords[0]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idy in np.arange(min_coords[1], max_coords[1]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idy in (min_coords[1], max_coords[1]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-            for idy in (min_coords[1], max_coords[1]-1):
-                edge_set = self.mb.create_meshset()
-                self.mb.add_child_meshset(face_set, edge_set)
-                for idx in np.arange(min_coords[0], max_coords[0]):
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(edge_set, [elem])
-
-                # Generate vertices
-                for idx in (min_coords[0], max_coords[0]-1):
-                    vertex_set = self.mb.create_meshset()
-                    self.mb.add_child_meshset(edge_set, vertex_set)
-
-                    elem = self._get_elem_by_ijk((idx, idy, idz))
-                    self.mb.add_entities(vertex_set, [elem])
-
-        return faces_sets
-
-    def _generate_dual_volume(self, bbox):
-        max_coords, min_coords = self._get_bbox_limit_coords(bbox)
-
-        dual_volume_set = self.mb.create_meshset()
-        for fine_block_i in np.arange(min_coords[0], max_coords[0]):
-            for fine_block_j in np.arange(min_coords[1], max_coords[1]):
-                for fine_block_k in np.arange(min_coords[2], max_coords[2]):
-                    fine_block_ijk = (fine_block_i, fine_block_j, fine_block_k)
-                    elem = self._get_elem_by_ijk(fine_block_ijk)
-                    self.mb.add_entities(dual_volume_set, [elem])
-
-        for face_set in self._generate_dual_faces(bbox):
-            self.mb.add_child_meshset(dual_volume_set, face_set)
-
-        return dual_volume_set
+        key = (tuple(free_dims), tuple(min_coords), tuple(max_coords))
+        try:
+            return self.dual_sets[key]
+        except KeyError:
+            pass
+
+        entity_set = self.mb.create_meshset()
+        self.dual_sets[key] = entity_set
+        if not (self.owned_cell_layers[0] <= min_coords[-1] <
+                self.owned_cell_layers[1]):
+            # Also built by the slab owning the box's first cell
+            self.ghost_dual_sets.append(entity_set)
+        self.mb.add_entities(
+            entity_set, self._get_elems_in_box(min_coords, max_coords))
+
+        for dim in free_dims:
+            sub_dims = [d for d in free_dims if d != dim]
+            for coord in sorted({min_coords[dim], max_coords[dim]-1}):
+                sub_min_coords = list(min_coords)
+                sub_max_coords = list(max_coords)
+                sub_min_coords[dim], sub_max_coords[dim] = coord, coord+1
+
+                sub_entity_set = self._generate_dual_entity(
+                    sub_min_coords, sub_max_coords, sub_dims)
+                self.mb.add_child_meshset(entity_set, sub_entity_set)
+
+        return entity_set
 
     def generate_dual(self):
-        min_coarse_ids = np.array([0, 0, 0])
-        max_coarse_ids = np.array([max(self.primal_ids[0]),
-                                   max(self.primal_ids[1]),
-                                   max(self.primal_ids[2])])
-
-        i = 0
-        for primal_id, primal in self.primals.items():
-            print("{0} / {1}".format(i, len(self.primals.keys())))
-            i += 1
-            # Generate dual corners (or primal centroids)
-            if all(np.array(primal_id) != min_coarse_ids) and \
-               all(np.array(primal_id) != max_coarse_ids):
-                primal_centroid = self._primal_centroid(primal_id)
-            else:
-                primal_centroid = self._primal_centroid(primal_id)
-
-                for dim in range(0, 3):
-                    if primal_id[dim] in (0, max_coarse_ids[dim]):
-                        multiplier = 1 if primal_id[dim] != 0 else 0
-
-                        primal_centroid[dim] = (multiplier *
-                                                (self.mesh_size[dim]-1))
-
-            self.primal_centroid_ijk[primal_id] = primal_centroid
-
-        # There are up to eight sectors that include each primal
-        primal_adjs_sectors = np.array([
-            # First sector
-            [[0, 0, 0], [0, 1, 0], [-1, 1, 0], [-1, 0, 0],
-             [0, 0, 1], [0, 1, 1], [-1, 1, 1], [-1, 0, 1]],
-            # Second sector
-            [[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0, 0],
-             [0, 0, 1], [0, 1, 1], [1, 1, 1], [1, 0, 1]],
-            # Third sector
-            [[0, 0, 0], [0, -1, 0], [-1, -1, 0], [-1, 0, 0],
-             [0, 0, 1], [0, -1, 1], [-1, -1, 1], [-1, 0, 1]],
-            # Fourth sector
-            [[0, 0, 0], [0, -1, 0], [1, -1, 0], [1, 0, 0],
-             [0, 0, 1], [0, -1, 1], [1, -1, 1], [1, 0, 1]],
-            # Now the same for the bottom-most sectors
-            [[0, 0, 0], [0, 1, 0], [-1, 1, 0], [-1, 0, 0],
-             [0, 0, -1], [0, 1, -1], [-1, 1, -1], [-1, 0, -1]],
-            [[0, 0, 0], [0, 1, 0], [1, 1, 0], [1, 0, 0],
-             [0, 0, -1], [0, 1, -1], [1, 1, -1], [1, 0, -1]],
-            [[0, 0, 0], [0, -1, 0], [-1, -1, 0], [-1, 0, 0],
-             [0, 0, -1], [0, -1, -1], [-1, -1, -1], [-1, 0, -1]],
-            [[0, 0, 0], [0, -1, 0], [1, -1, 0], [1, 0, 0],
-             [0, 0, -1], [0, -1, -1], [1, -1, -1], [1, 0, -1]],
-        ])
-        i = 0
-        for primal_id, primal in self.primals.items():
-            print("{0} / {1}".format(i, len(self.primals.keys())))
-            i += 1
-            collocation_point = self._get_elem_by_ijk(
-                self.primal_centroid_ijk[primal_id])
+        # Generate dual corners (or primal centroids)
+        dims = coarse_dims(self.primal_ids)
+        ndim = len(dims)
+        owned = self._owned_primals()
+        first, last = self.primal_layers
+        origin = [0] * (ndim - 1) + [first]
+
+        primals_ijk = grid_ijk(dims[:-1] + [last - first]) + origin
+        centroids = primal_centroids(
+            primals_ijk, self.coarse_ratio, dims, self.mesh_size)
+
+        self.mb.tag_set_data(
+            self.primal_centroid_tag, self.primals.array.ravel()[owned],
+            centroids.astype('int32').ravel())
+        self.primal_centroid_ijk = GridMap(
+            centroids.reshape((last - first,) + tuple(dims[-2::-1]) +
+                              (ndim,)), ndim, origin)
+
+        # Each collocation point is shared by up to 2**ndim dual volumes
+        axis_coords = axis_centroids(dims, self.coarse_ratio, self.mesh_size)
+
+        volume_boxes = dual_volume_boxes(primals_ijk, axis_coords)
+
+        collocation_points = np.empty(len(primals_ijk), dtype='uint64')
+        collocation_point_root_sets = np.empty(
+            len(primals_ijk), dtype='uint64')
+        for i, (centroid, boxes) in enumerate(zip(centroids, volume_boxes)):
+            self.instrumentation.progress(i + 1, len(primals_ijk))
+            collocation_point = self._get_elem_by_ijk(centroid)
 
             collocation_point_root_ms = self.mb.create_meshset()
             self.mb.add_entities(
                 collocation_point_root_ms, [collocation_point])
 
-            for sector in primal_adjs_sectors:
-                bbox = self._generate_sector_bounding_box(primal_id, sector)
-                # Check if the sector's bounding box has 8 points (this may
-                # not be the case for all sectors of a corner collocation
-                # point)
-                if len(bbox) != 8:
-                    continue
-
-                volume_set = self._generate_dual_volume(bbox)
+            for min_coords, max_coords in boxes:
+                volume_set = self._generate_dual_entity(
+                    min_coords, max_coords, range(ndim))
                 self.mb.add_child_meshset(
                     collocation_point_root_ms, volume_set)
 
-            self.mb.tag_set_data(
-                self.collocation_point_tag,
-                collocation_point_root_ms,
-                collocation_point)
+            collocation_points[i] = collocation_point
+            collocation_point_root_sets[i] = collocation_point_root_ms
+
+        self.mb.tag_set_data(
+            self.collocation_point_tag,
+            collocation_point_root_sets,
+            collocation_points)
+        self._tag_ghost(np.array(self.ghost_dual_sets, dtype='uint64'))
@@ -1,12 +1,11 @@
-import time
-
 from .StructuredMultiscaleMesh import StructuredMultiscaleMesh
+from ...Common.Instrumentation import Instrumentation
 
 
 class Preprocessor(object):
     """
-    Creates a 3-D structured grid and aggregates elements in primal and dual
-    coarse entities.
+    Creates a 2-D structured grid of quadrilaterals and aggregates elements in
+    primal and dual coarse entities.
     """
 
     def __init__(self, configs):
@@ -17,30 +16,29 @@ class Preprocessor(object):
         self.mesh_size = self.structured_configs['mesh-size']
         self.block_size = self.structured_configs['block-size']
 
+        self.instrumentation = Instrumentation.from_configs(self.configs)
         self.smm = StructuredMultiscaleMesh(
-            self.coarse_ratio, self.mesh_size, self.block_size)
+            self.coarse_ratio, self.mesh_size, self.block_size,
+            self.instrumentation)
 
     def run(self, moab):
-        self.smm.set_moab(moab)
+        self.smm.set_moab(self.instrumentation.wrap(moab))
 
         self.smm.calculate_primal_ids()
         self.smm.create_tags()
 
-        print("Creating fine vertices...")
-        t0 = time.time()
-        self.smm.create_fine_vertices()
-        print("took {0}\n".format(time.time()-t0))
+        with self.instrumentation.stage("Creating fine vertices"):
+            self.smm.create_fine_vertices()
+
+        with self.instrumentation.stage("Creating fine blocks and primal"):
+            self.smm.create_fine_blocks_and_primal()
 
-        print("Creating fine blocks and primal...")
-        t0 = time.time()
-        self.smm.create_fine_blocks_and_primal()
-        print("took {0}\n".format(time.time()-t0))
+        with self.instrumentation.stage("Generating dual"):
+            self.smm.generate_dual()
+            self.smm.store_primal_adj()
 
-        print("Generating dual...")
-        t0 = time.time()
-        self.smm.generate_dual()
-        self.smm.store_primal_adj()
-        print("took {0}\n".format(time.time()-t0))
+        self.instrumentation.write_report(
+            self.configs['General']['output-file'])
 
     @property
     def structured_configs(self):
@@ -49,7 +47,7 @@ class Preprocessor(object):
     @structured_configs.setter
     def structured_configs(self, configs):
         if not configs:
-            raise ValueError("Must have a [StructuredMS] section "
+            raise ValueError("Must have a [Structured2DMS] section "
                              "in the config file.")
 
         self._structured_configs = configs
@@ -62,8 +60,8 @@ class Preprocessor(object):
     def coarse_ratio(self, values):
         if not values:
             raise ValueError("Must have a coarse-ratio option "
-                             "under the [StructuredMS] section in the config "
-                             "file.")
+                             "under the [Structured2DMS] section in the "
+                             "config file.")
 
         self._coarse_ratio = [int(v) for v in values]
 
@@ -75,8 +73,8 @@ class Preprocessor(object):
     def mesh_size(self, values):
         if not values:
             raise ValueError("Must have a mesh-size option "
-                             "under the [StructuredMS] section in the config "
-                             "file.")
+                             "under the [Structured2DMS] section in the "
+                             "config file.")
 
         self._mesh_size = [int(v) for v in values]
 
@@ -88,7 +86,7 @@ class Preprocessor(object):
     def block_size(self, values):
         if not values:
             raise ValueError("Must have a block-size option "
-                             "under the [StructuredMS] section in the config "
-                             "file.")
+                             "under the [Structured2DMS] section in the "
+                             "config file.")
 
         self._block_size = [int(v) for v in values]
@@ -0,0 +1,296 @@
+"""
+Local flow problems of the flow-based permeability upscaling, built for a
+whole primal block at once from its permeability sub-array.
+
+A block is given by its (nz, ny, nx, 3) diagonal permeability and by the
+sizes of its cells along x, y and z. Its cells are numbered x fastest.
+Pressure is fixed to 1 on the first layer of cells along the flow direction
+and to 0 on the last one, and the two-point flux approximation over the
+cells' faces gives the equations of the others.
+
+The functions here only take and return arrays, so that blocks can be
+upscaled in worker processes.
+"""
+import numpy as np
+from PyTrilinos import Epetra, Amesos
+
+
+# Bound on the memory of the dense matrices of a batch of blocks
+BATCH_BYTES = 64 * 2 ** 20
+
+
+def _axis_slices(ndim, axis, first, last):
+    # Slices picking cells first to last along the array axis of a grid axis
+    slices = [slice(None)] * ndim
+    slices[ndim - 1 - axis] = slice(first, last)
+    return tuple(slices)
+
+
+def _along(values, axis, ndim):
+    # Broadcast per-cell values of a grid axis along its array axis
+    shape = [1] * ndim
+    shape[ndim - 1 - axis] = len(values)
+    return np.reshape(values, shape)
+
+
+def transmissibilities(perm, cell_sizes):
+    """Equivalent permeability of the faces between neighbouring cells of a
+    block, and the distance it is taken over.
+
+    Parameters
+    ----------
+    perm: Array of floats
+        (nz, ny, nx, 3) x, y and z permeabilities of the cells.
+    cell_sizes: List of arrays of floats
+        Size of the cells along x, y and z.
+
+    Returns
+    -------
+    List holding, for each axis, the (k_eq, dl) pair of arrays over the
+    faces normal to it, shaped as the block with one cell less along the
+    axis. k_eq = 2 K1 K2 / (K1 dl + K2 dl) is the harmonic average of the
+    permeabilities of the two cells over dl, the mean of their half sizes.
+    """
+    ndim = perm.ndim - 1
+    faces = []
+    for axis in range(ndim):
+        K = perm[..., axis]
+        K1 = K[_axis_slices(ndim, axis, None, -1)]
+        K2 = K[_axis_slices(ndim, axis, 1, None)]
+        half_sizes = np.asarray(cell_sizes[axis], dtype='float64') / 2
+        dl = _along((half_sizes[:-1] + half_sizes[1:]) / 2, axis, ndim)
+        faces.append(((2 * K1 * K2) / (K1 * dl + K2 * dl),
+                      np.broadcast_to(dl, K1.shape)))
+    return faces
+
+
+def boundary_rows(shape, dim):
+    """Linear index of the first and of the last layer of cells along dim."""
+    ndim = len(shape)
+    index = np.arange(int(np.prod(shape))).reshape(shape)
+    return (index[_axis_slices(ndim, dim, 0, 1)].ravel(),
+            index[_axis_slices(ndim, dim, -1, None)].ravel())
+
+
+def face_entries(shape, faces):
+    """Off-diagonal entries of the matrix over the faces of a block, before
+    any boundary condition, as COO arrays (rows, cols, values)."""
+    ndim = len(shape)
+    index = np.arange(int(np.prod(shape)), dtype='int32').reshape(shape)
+
+    rows, cols, values = [], [], []
+    for axis, (k_eq, _) in enumerate(faces):
+        lo = index[_axis_slices(ndim, axis, None, -1)].ravel()
+        hi = index[_axis_slices(ndim, axis, 1, None)].ravel()
+        k_eq = k_eq.ravel()
+        rows.extend((lo, hi))
+        cols.extend((hi, lo))
+        values.extend((-k_eq, -k_eq))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+
+
+def assemble(perm, cell_sizes, dims=(0, 1, 2), faces=None):
+    """Matrix and right-hand side of the local problems driving flow along
+    each of dims, as one block-diagonal system in row-ordered COO arrays.
+
+    The faces are assembled once; each problem then only differs by its
+    boundary rows, which hold the identity. Cells of the m-th problem are
+    numbered from m times the number of cells of the block.
+
+    Parameters
+    ----------
+    perm, cell_sizes:
+        As in transmissibilities.
+    dims: Sequence of integers
+        Axes of the flow, 0, 1 or 2 for x, y and z.
+    faces: List, optional
+        The transmissibilities of the block, when already computed.
+
+    Returns
+    -------
+    (rows, cols, values, b) where rows and cols are int32 arrays and b is
+    the right-hand side.
+    """
+    shape = perm.shape[:-1]
+    n_cells = int(np.prod(shape))
+    if faces is None:
+        faces = transmissibilities(perm, cell_sizes)
+    face_rows, face_cols, face_values = face_entries(shape, faces)
+    cells = np.arange(n_cells, dtype='int32')
+
+    rows, cols, values, b = [], [], [], []
+    for m, dim in enumerate(dims):
+        first, last = boundary_rows(shape, dim)
+        is_boundary = np.zeros(n_cells, dtype=bool)
+        is_boundary[first] = True
+        is_boundary[last] = True
+
+        interior = ~is_boundary[face_rows]
+        diagonal = -np.bincount(face_rows[interior], face_values[interior],
+                                n_cells)
+        diagonal[is_boundary] = 1.0
+
+        offset = m * n_cells
+        rows.extend((face_rows[interior] + offset, cells + offset))
+        cols.extend((face_cols[interior] + offset, cells + offset))
+        values.extend((face_values[interior], diagonal))
+
+        dim_b = np.zeros(n_cells)
+        dim_b[first] = 1.0
+        dim_b[last] = 0.0
+        b.append(dim_b)
+
+    rows = np.concatenate(rows)
+    order = np.argsort(rows, kind='mergesort')
+    return (rows[order], np.concatenate(cols)[order],
+            np.concatenate(values)[order], np.concatenate(b))
+
+
+def effective_permeability(pressure, cell_sizes, dim, faces):
+    """Upscaled permeability along dim from the pressure solving the local
+    problem.
+
+    It is the flow through the faces between the boundary layers and their
+    inner neighbours, times the mean distance it is taken over, divided by
+    the area of those faces. Blocks with fewer than three cells along dim
+    have no such face, and raise a ValueError.
+
+    Parameters
+    ----------
+    pressure: Array of floats
+        (nz, ny, nx) pressure of the cells.
+    cell_sizes, dim, faces:
+        As in assemble.
+    """
+    ndim = pressure.ndim
+    n = pressure.shape[ndim - 1 - dim]
+    if n < 3:
+        raise ValueError(
+            "A block of {0} cell(s) along axis {1} has no inner face to "
+            "upscale its permeability from; flow-based upscaling needs at "
+            "least 3.".format(n, dim))
+
+    area = np.ones(1)
+    for axis in range(ndim):
+        if axis != dim:
+            area = area * _along(cell_sizes[axis], axis, ndim)
+
+    k_eq, dl = faces[dim]
+    first_faces = _axis_slices(ndim, dim, 0, 1)
+    last_faces = _axis_slices(ndim, dim, n - 2, n - 1)
+    area = np.broadcast_to(area, k_eq[first_faces].shape).ravel()
+
+    area = np.concatenate((area, area))
+    k_eq = np.concatenate((k_eq[first_faces].ravel(),
+                           k_eq[last_faces].ravel()))
+    dl = np.concatenate((dl[first_faces].ravel(), dl[last_faces].ravel()))
+    inner_pressure = np.concatenate((
+        pressure[_axis_slices(ndim, dim, 1, 2)].ravel(),
+        pressure[_axis_slices(ndim, dim, n - 2, n - 1)].ravel()))
+
+    flow_rate = np.sum(area * k_eq * inner_pressure / dl)
+    return flow_rate * np.mean(dl) / np.sum(area)
+
+
+def solve(perm, cell_sizes, comm=None):
+    """Upscaled permeability of a block along x, y and z, and the pressure
+    of the local flow problems they come from.
+
+    The three problems share the assembly of the block's faces and are
+    solved together as one block-diagonal system, with a single sparse
+    direct factorization.
+
+    Parameters
+    ----------
+    perm, cell_sizes:
+        As in transmissibilities.
+    comm: Epetra communicator, optional
+        Defaults to Epetra.PyComm().
+
+    Returns
+    -------
+    The (3,) upscaled permeabilities and the (3, nz, ny, nx) pressures.
+    """
+    faces = transmissibilities(perm, cell_sizes)
+    rows, cols, values, b_values = assemble(perm, cell_sizes, faces=faces)
+
+    std_map = Epetra.Map(len(b_values), 0, comm or Epetra.PyComm())
+    A = Epetra.CrsMatrix(Epetra.Copy, std_map, 7)
+    A.InsertGlobalValues(rows, cols, values)
+    A.FillComplete()
+
+    b = Epetra.Vector(std_map)
+    b[:] = b_values
+    x = Epetra.Vector(std_map)
+
+    linearProblem = Epetra.LinearProblem(A, x, b)
+    solver = Amesos.Klu(linearProblem)
+    solver.SymbolicFactorization()
+    solver.NumericFactorization()
+    solver.Solve()
+
+    pressures = np.asarray(x).reshape((3,) + perm.shape[:-1])
+    return (np.array([effective_permeability(pressure, cell_sizes, dim, faces)
+                      for dim, pressure in enumerate(pressures)]),
+            pressures)
+
+
+def solve_dense(perms, cell_sizes):
+    """Upscaled permeabilities of a stack of same-shaped blocks, as solve
+    gives them, from dense systems solved all at once.
+
+    The matrices of the three problems of every block are stacked and handed
+    to a single batched LAPACK solve, which pays off for blocks of up to a
+    few hundred cells.
+
+    Parameters
+    ----------
+    perms: Array of floats
+        (B, nz, ny, nx, 3) x, y and z permeabilities of the blocks' cells.
+    cell_sizes: List of arrays of floats
+        Size of the cells along x, y and z, the same for every block.
+
+    Returns
+    -------
+    The (B, 3) upscaled permeabilities.
+    """
+    n_blocks = len(perms)
+    shape = perms.shape[1:-1]
+    n_cells = int(np.prod(shape))
+
+    A = np.zeros((n_blocks, 3 * n_cells * n_cells))
+    b = np.zeros((n_blocks, 3 * n_cells))
+    blocks_faces = []
+    for block, perm in enumerate(perms):
+        faces = transmissibilities(perm, cell_sizes)
+        rows, cols, values, b[block] = assemble(perm, cell_sizes, faces=faces)
+        # Row m * n + r of the block-diagonal system is row r of the m-th
+        # n x n matrix
+        A[block, rows * n_cells + cols % n_cells] = values
+        blocks_faces.append(faces)
+
+    pressures = np.linalg.solve(
+        A.reshape(-1, n_cells, n_cells), b.reshape(-1, n_cells, 1))
+    pressures = pressures.reshape((n_blocks, 3) + shape)
+    return np.array([[effective_permeability(pressure, cell_sizes, dim, faces)
+                      for dim, pressure in enumerate(block_pressures)]
+                     for block_pressures, faces in zip(pressures,
+                                                       blocks_faces)])
+
+
+def batch_size(n_cells, dense):
+    """Number of blocks of n_cells cells upscaled together, bounded by the
+    memory of their dense matrices."""
+    if not dense:
+        return 1
+    return max(1, BATCH_BYTES // (3 * n_cells * n_cells * 8))
+
+
+def upscale_blocks(args):
+    """Upscaled permeabilities of a (perms, cell_sizes, dense) stack of
+    same-shaped blocks, as process pools map it: all at once with
+    solve_dense when dense, one sparse solve per block otherwise."""
+    perms, cell_sizes, dense = args
+    if dense:
+        return solve_dense(perms, cell_sizes)
+    return np.array([solve(perm, cell_sizes)[0] for perm in perms])
@@ -1,5 +1,6 @@
-import time
 from StructuredUpscalingMethods import StructuredUpscalingMethods
+from ...Common.Averaging import parse_average
+from ...Common.Instrumentation import Instrumentation, as_bool
 
 
 class Preprocessor(object):
@@ -23,79 +24,110 @@ class Preprocessor(object):
         self.values = self.structured_configs['block-size']
         self.block_size = [float(v) for v in self.values]
 
+        self.phi_file = self.structured_configs.get('phi-file', 'spe_phi.dat')
+        self.perm_file = self.structured_configs.get(
+            'perm-file', 'spe_perm.dat')
+        self.ntg_file = self.structured_configs.get('ntg-file')
+        self.cache = as_bool(self.structured_configs.get('cache', True))
+
+        # The property files may cover a larger model, of which the mesh takes
+        # the box of cells starting at origin
+        self.model_size = self.structured_configs.get('model-size')
+        if self.model_size is not None:
+            self.model_size = [int(v) for v in self.model_size]
+        self.origin = [int(v) for v in self.structured_configs.get(
+            'origin', (0, 0, 0))]
+
         self.method = self.structured_configs['method']
         if self.method == "Average":
+            # Either a single average or a list of them, each given by name
+            # or by power exponent
             self.average = self.structured_configs['average']
-            if self.average not in ('Arithmetic', 'Geometric', 'Harmonic'):
-                print("Choose either Arithmetic, Geometric or Harmonic.")
+            if not isinstance(self.average, list):
+                self.average = [self.average]
+            try:
+                self.average_labels = [parse_average(average)[0]
+                                       for average in self.average]
+            except ValueError:
+                print("Choose either Arithmetic, Geometric, Harmonic or "
+                      "power exponents.")
                 exit()
         elif self.method != 'Flow-based':
             print("Choose either Flow-based or Average.")
             exit()
 
+        # Processes sharing the flow-based local problems
+        self.workers = int(self.structured_configs.get('workers', 1))
+        if self.workers < 1:
+            print("The workers option must be a positive integer.")
+            exit()
+
+        # Largest flow-based local problems solved in batches of dense
+        # systems, 0 sends every one to the sparse solver
+        self.dense_cells = int(self.structured_configs.get('dense-cells', 216))
+
+        self.instrumentation = Instrumentation.from_configs(self.configs)
+
     def run(self, moab):
 
         self.SUM = StructuredUpscalingMethods(
             self.coarse_ratio, self.mesh_size, self.block_size, self.method,
-            moab)
+            self.instrumentation.wrap(moab), self.instrumentation)
         self.SUM.calculate_primal_ids()
+        if (self.method == 'Flow-based' and
+                self.fine_grid_construct != 'fine_grid'):
+            # Fail before reading the property maps
+            self.SUM.check_flow_based_primals()
         self.SUM.create_tags()
 
-        print("Creating fine vertices...")
-        t0 = time.time()
-        self.SUM.create_fine_vertices()
-        print("took {0}".format(time.time() - t0), "seconds...")
+        with self.instrumentation.stage("Creating fine vertices"):
+            self.SUM.create_fine_vertices()
 
-        print("Reading porosity map...")
-        t0 = time.time()
-        self.SUM.read_phi()
-        print("took {0}".format(time.time() - t0), "seconds...")
+        with self.instrumentation.stage("Reading porosity map"):
+            self.SUM.read_phi(self.phi_file, self.cache, self.model_size,
+                              self.origin)
 
-        print("Reading permeability map...")
-        t0 = time.time()
-        self.SUM.read_perm()
-        print("took {0}".format(time.time() - t0), "seconds...")
+        if self.ntg_file is not None:
+            with self.instrumentation.stage("Reading net-to-gross map"):
+                self.SUM.read_ntg(self.ntg_file, self.cache, self.model_size,
+                                  self.origin)
 
-        print("Associating fine volumes to primal coarse grid...")
-        t0 = time.time()
-        self.SUM.create_fine_blocks_and_primal()
-        print("took {0}".format(time.time()-t0), "seconds...")
+        with self.instrumentation.stage("Reading permeability map"):
+            self.SUM.read_perm(self.perm_file, self.cache, self.model_size,
+                               self.origin)
+
+        with self.instrumentation.stage(
+                "Associating fine volumes to primal coarse grid"):
+            self.SUM.create_fine_blocks_and_primal()
 
         if self.fine_grid_construct == 'fine_grid':
-            print("exporting fine scale mesh")
-            t0 = time.time()
-            # self.SUM.create_wells()
-            self.SUM.export(self.output_file)
-            print("took {0}".format(time.time()-t0), "seconds...")
+            with self.instrumentation.stage("Exporting fine scale mesh"):
+                # self.SUM.create_wells()
+                self.SUM.export(self.output_file)
+            self.instrumentation.write_report(self.output_file)
             exit()
 
-        print("Upscaling the porosity...")
-        t0 = time.time()
-        self.SUM.upscale_phi()
-        print("took {0}".format(time.time()-t0), "seconds...")
-
-        print("{0}".format(self.method), "upscaling for the permeability")
+        with self.instrumentation.stage("Upscaling the porosity"):
+            self.SUM.upscale_phi()
 
         if self.method == "Average":
-            print("{0}".format(self.average), "mean...")
-            t0 = time.time()
-            self.SUM.upscale_perm_mean(self.average)
-            print("took {0}".format(time.time()-t0), "seconds...")
+            with self.instrumentation.stage(
+                    "{0} mean upscaling for the permeability".format(
+                        ', '.join(self.average_labels))):
+                self.SUM.upscale_perm_mean(self.average)
 
         if self.method == "Flow-based":
-            print("Setting Local Upscaling...")
-            t0 = time.time()
-            self.SUM.flow_based_coarse_perm()
-            print("took {0}".format(time.time()-t0), "seconds...")
-
-        print("Generating coarse scale grid...")
-        t0 = time.time()
-        self.SUM.coarse_grid()
-        # self.SUM.create_wells()
-        print("took {0}".format(time.time()-t0), "seconds...")
-
-        print("Exporting...")
-        t0 = time.time()
-        self.SUM.export(self.output_file)
-        self.SUM.export_data()
-        print("took {0}\n".format(time.time()-t0))
+            with self.instrumentation.stage(
+                    "Flow-based upscaling for the permeability"):
+                self.SUM.flow_based_coarse_perm(self.workers,
+                                                self.dense_cells)
+
+        with self.instrumentation.stage("Generating coarse scale grid"):
+            self.SUM.coarse_grid()
+            # self.SUM.create_wells()
+
+        with self.instrumentation.stage("Exporting"):
+            self.SUM.export(self.output_file)
+            self.SUM.export_data()
+
+        self.instrumentation.write_report(self.output_file)
@@ -1,9 +1,24 @@
+import multiprocessing
+
 import numpy as np
 import collections
-import time
 from pymoab import types
-from pymoab import topo_util
-from PyTrilinos import Epetra, AztecOO, ML
+
+from ...Common.StructuredGrid import (
+    axis_nodes, vertex_coords, handles_array, cell_vertex_ids,
+    axis_primal_ids, coarse_dims, grid_ijk, cell_primal_ids, face_adjacency,
+    group_by, primal_centroids, GridMap, AdjacencyMap, StructuredGrid)
+from ...Common.Averaging import group_sums, parse_average, power_means
+from ...Common.Instrumentation import Instrumentation
+from ...Common.PropertyReader import check_size, read_property, read_window
+from .FlowBasedUpscaling import batch_size, upscale_blocks
+
+
+def _diagonal_tensors(diagonals):
+    """Flat (N * 9,) buffer of the tensors of the (N, 3) diagonals."""
+    tensors = np.zeros((len(diagonals), 9))
+    tensors[:, [0, 4, 8]] = diagonals
+    return tensors.ravel()
 
 
 class StructuredUpscalingMethods:
@@ -19,42 +34,48 @@ class StructuredUpscalingMethods:
         block_size List o array of floats
             List or array containing three values indicating the constant
             increments of vertex coordinates in x, y and z.
+        instrumentation: Instrumentation, optional
+            Receives the progress and the solver counters of the upscaling.
         """
-    def __init__(self, coarse_ratio, mesh_size, block_size, method, moab):
+    def __init__(self, coarse_ratio, mesh_size, block_size, method, moab,
+                 instrumentation=None):
 
         self.coarse_ratio = coarse_ratio
         self.mesh_size = mesh_size
         self.block_size = block_size
         self.method = method
+        self.instrumentation = instrumentation or Instrumentation()
 
         self.verts = None  # Array containing MOAB vertex entities
-        self.elems = []  # List containing MOAB volume entities
 
         self.coarse_verts = None  # Array containing MOAB vertex entities for
         #                           the coarse mesh
-        self.coarse_elems = []  # List containig MOAB volume entities for the
-        #                         coarse mesh
+        self.coarse_grid_index = None  # Index arithmetic over the coarse
+        #                                MOAB volumes
 
         self.primals = {}  # Mapping from tuples (idx, dy, idz) to Coarse
-        #                    volumes
-        self.primal_ids = []
+        #                    volumes, backed by an (nz, ny, nx) array
+        self.primal_ids = []  # Primal index of fine cells along each axis
 
-        self.primals_adj = []
+        self.primal_adj = {}
+
+        self.grid = None  # Index arithmetic and geometry over the fine MOAB
+        #                   volumes
 
         self.perm = []
+        self.ntg_values = None  # Net-to-gross of the fine volumes, if read
+        self.fine_phi = None  # Porosity of the fine volumes
+        self.fine_perm = None  # (N, 3) x, y and z permeabilities of the fine
+        #                        volumes
+        self.fine_primal_ids = None  # Primal id of each fine volume
+
+        # (n_primals, 3) permeabilities and tag of each average, by label
+        self.perm_averages = collections.OrderedDict()
+        self.perm_average_tags = collections.OrderedDict()
 
         # MOAB boilerplate
         self.mb = moab
         self.root_set = self.mb.get_root_set()
-        self.mesh_topo_util = topo_util.MeshTopoUtil(self.mb)
-
-        # Pytrilinos boilerplate
-        self.comm = Epetra.PyComm()
-        self.mlList = {"max levels": 3,
-                       "output": 10,
-                       "smoother: type": "symmetric Gauss-Seidel",
-                       "aggregation: type": "Uncoupled"
-                       }
 
     def create_tags(self):
         # TODO: - Should go on Common (?)
@@ -108,6 +129,10 @@ class StructuredUpscalingMethods:
             "PRIMAL_PHI", 1, types.MB_TYPE_DOUBLE,
             types.MB_TAG_SPARSE, True)
 
+        self.primal_pore_volume_tag = self.mb.tag_get_handle(
+            "PRIMAL_PORE_VOLUME", 1, types.MB_TYPE_DOUBLE,
+            types.MB_TAG_SPARSE, True)
+
         self.perm_tag = self.mb.tag_get_handle(
             "PERM", 9, types.MB_TYPE_DOUBLE,
             types.MB_TAG_SPARSE, True)
@@ -161,13 +186,8 @@ class StructuredUpscalingMethods:
 
         block_size_coarse = self.get_block_size_coarse()
 
-        coarse_coords = np.array([
-            (i, j, k)
-            for k in (np.array(block_size_coarse[2], dtype='float64'))
-            for j in (np.array(block_size_coarse[1], dtype='float64'))
-            for i in (np.array(block_size_coarse[0], dtype='float64'))
-            ])
-        return self.mb.create_vertices(coarse_coords.flatten())
+        return self.mb.create_vertices(vertex_coords(
+            [np.array(nodes, dtype='float64') for nodes in block_size_coarse]))
 
     def _coarse_dims(self,):
         # TODO: - Should go on Common
@@ -178,487 +198,321 @@ class StructuredUpscalingMethods:
         return mesh_size_coarse
 
     def calculate_primal_ids(self):
-        # TODO: - Should go on Common
-        for dim in range(0, 3):
-            self.primal_ids.append(
-                [i // (self.coarse_ratio[dim]) for i in xrange(
-                        self.mesh_size[dim])])
-
-        new_primal = []
-        for dim in range(0, 3):
-            new_primal.append(
-                self.primal_ids[dim][(
-                    self.mesh_size[dim] // self.coarse_ratio[dim]) *
-                                     self.coarse_ratio[dim]:])
-
-            if len(new_primal[dim]) < (self.mesh_size[dim] // 2):
-                new_primal[dim] = np.repeat(
-                    max(self.primal_ids[dim]) - 1,
-                    len(new_primal[dim])).tolist()
-                self.primal_ids[dim] = (self.primal_ids[dim][:self.mesh_size[
-                    dim] // self.coarse_ratio[dim] * self.coarse_ratio[dim]] +
-                                        new_primal[dim])
+        self.primal_ids = axis_primal_ids(self.mesh_size, self.coarse_ratio)
 
     def create_fine_vertices(self):
-        # TODO: - Should go on Common
-
-        coords = np.array([
-            (i, j, k) for k in (np.arange(
-                self.mesh_size[2] + 1, dtype='float64') *
-                                self.block_size[2])
-            for j in (np.arange(
-                self.mesh_size[1] + 1, dtype='float64') *
-                      self.block_size[1])
-            for i in (np.arange(
-                self.mesh_size[0] + 1, dtype='float64') *
-                      self.block_size[0])
-        ], dtype='float64')
-        return self.mb.create_vertices(coords.flatten())
-
-    def _create_hexa(self, i, j, k,  verts, mesh):
-        # TODO: - Should go on Common
-        #       - Refactor this (????????)
-                # (i, j, k)
-        hexa = [verts[i + (j * (mesh[0] + 1)) +
-                      (k * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i+1, j, k)
-                verts[(i + 1) + (j * (mesh[0] + 1)) +
-                      (k * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i+1, j+1, k)
-                verts[(i + 1) + (j + 1) * (mesh[0]) +
-                      (j + 1) + (k * ((mesh[0] + 1)*(mesh[1] + 1)))],
-                # (i, j+1, k)
-                verts[i + (j + 1) * (mesh[0]) + (j + 1) +
-                      (k * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i, j, k+1)
-                verts[i + (j * (mesh[0] + 1)) +
-                      ((k + 1) * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i+1, j, k+1)
-                verts[(i + 1) + (j * (mesh[0] + 1)) +
-                      ((k + 1) * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i+1, j+1, k+1)
-                verts[(i + 1) + (j + 1) * (mesh[0]) +
-                      (j + 1) + ((k + 1) * ((mesh[0] + 1) * (mesh[1] + 1)))],
-                # (i, j+1, k+1)
-                verts[i + (j + 1) * (mesh[0]) +
-                      (j + 1) + ((k + 1) * ((mesh[0] + 1) * (mesh[1] + 1)))]]
-
-        return hexa
-
-    def _coarsening_ratio(self, dim):
-        coarsening = (collections.Counter(self.primal_ids[dim]))
-        return coarsening.values()
+        self.verts = self.mb.create_vertices(vertex_coords(
+            [axis_nodes(n, size)
+             for n, size in zip(self.mesh_size, self.block_size)]))
 
     def create_fine_blocks_and_primal(self):
         # TODO: - Should go on Common
-        fine_vertices = self.create_fine_vertices()
-        cur_id = 0
-        # Create fine grid
-        for k, idz in zip(xrange(self.mesh_size[2]),
-                          self.primal_ids[2]):
-            # Flake8 bug
-            print("{0} / {1}".format(k + 1, self.mesh_size[2]))
-            for j, idy in zip(xrange(self.mesh_size[1]),
-                              self.primal_ids[1]):
-                for i, idx in zip(xrange(self.mesh_size[0]),
-                                  self.primal_ids[0]):
-
-                    hexa = self._create_hexa(i, j, k,
-                                             fine_vertices,
-                                             self.mesh_size)
-                    el = self.mb.create_element(types.MBHEX, hexa)
-
-                    self.mb.tag_set_data(self.gid_tag, el, cur_id)
-                    # Fine Global ID
-                    self.mb.tag_set_data(self.gid_tag, el, cur_id)
-                    # Fine Porosity
-                    self.mb.tag_set_data(self.phi_tag, el, self.phi_values[
-                        cur_id])
-                    # Fine Permeability tensor
-                    self.mb.tag_set_data(self.perm_tag, el, [
-                        self.perm_values[cur_id], 0, 0,
-                        0, self.perm_values[cur_id + self.mesh_size[0] *
-                                            self.mesh_size[1] *
-                                            self.mesh_size[2]], 0,
-                        0, 0, self.perm_values[cur_id + 2*self.mesh_size[0] *
-                                               self.mesh_size[1] *
-                                               self.mesh_size[2]]])
-                    self.mb.tag_set_data(self.abs_perm_fine_x_tag, el,
-                                         self.perm_values[cur_id])
-                    self.elems.append(el)
-                    cur_id += 1
-
-                    # Create primal coarse grid
-                    try:
-                        primal = self.primals[(idx, idy, idz)]
-                        self.mb.add_entities(primal, [el])
-                        self.mb.tag_set_data(
-                            self.fine_to_primal_tag, el, primal)
-                    except KeyError:
-                        primal = self.mb.create_meshset()
-                        self.primals[(idx, idy, idz)] = primal
-                        self.mb.add_entities(primal, [el])
-                        self.mb.tag_set_data(
-                            self.fine_to_primal_tag, el, primal)
-
-                        # do a 'if flow based generate mesh bc over here'
-
-        primal_id = 0
-        for primal in self.primals.values():
-            self.mb.tag_set_data(self.primal_id_tag, primal, primal_id)
-            primal_id += 1
+        verts = handles_array(self.verts)
+        elems = handles_array(self.mb.create_elements(
+            types.MBHEX, verts[cell_vertex_ids(self.mesh_size)]))
+        self.grid = StructuredGrid(self.mesh_size, self.block_size, elems)
+
+        n_cells = len(elems)
+        phi = check_size('The porosity map', np.asarray(
+            self.phi_values, dtype='float64'), n_cells)
+        self.fine_phi = phi
+        # x, y and z permeabilities of each cell as the diagonal of its tensor
+        perm = check_size('The permeability map', np.asarray(
+            self.perm_values, dtype='float64'), 3 * n_cells).reshape(
+                3, n_cells).T
+        self.fine_perm = perm
+
+        self.mb.tag_set_data(
+            self.gid_tag, elems, np.arange(n_cells, dtype='int32'))
+        self.mb.tag_set_data(self.phi_tag, elems, phi)
+        self.mb.tag_set_data(self.perm_tag, elems, _diagonal_tensors(perm))
+        self.mb.tag_set_data(
+            self.abs_perm_fine_x_tag, elems, np.ascontiguousarray(perm[:, 0]))
+
+        # Create primal coarse grid
+        dims = coarse_dims(self.primal_ids)
+        n_primals = int(np.prod(dims))
+        elems_primal_id = cell_primal_ids(self.primal_ids)
+        order, offsets = group_by(elems_primal_id, n_primals)
+        self.fine_primal_ids = elems_primal_id
+
+        primals = np.array([self.mb.create_meshset()
+                            for _ in xrange(n_primals)], dtype='uint64')
+        for primal, start, end in zip(primals, offsets[:-1], offsets[1:]):
+            self.mb.add_entities(primal, elems[order[start:end]])
+
+        self.mb.tag_set_data(
+            self.fine_to_primal_tag, elems, primals[elems_primal_id])
+        self.mb.tag_set_data(
+            self.primal_id_tag, primals, np.arange(n_primals, dtype='int32'))
+
+        self.primals = GridMap(primals.reshape(dims[::-1]))
 
     def store_primal_adj(self):
         # TODO: - Should go on Common
-        min_coarse_ids = np.array([0, 0, 0])
-        max_coarse_ids = np.array([max(self.primal_ids[0]),
-                                   max(self.primal_ids[1]),
-                                   max(self.primal_ids[2])])
-
-        for primal_id, primal in self.primals.iteritems():
-            adj = self.mb.create_meshset()
-            adj_ids = []
-
-            for i in np.arange(-1, 2):
-                for j in np.arange(-1, 2):
-                    for k in np.arange(-1, 2):
-                        coord_inc = np.array([i, j, k])
-                        adj_id = primal_id + coord_inc
-                        if any(adj_id != primal_id) and \
-                           (sum(coord_inc == [0, 0, 0]) == 2) and \
-                           all(adj_id >= min_coarse_ids) and \
-                           all(adj_id <= max_coarse_ids):
+        dims = coarse_dims(self.primal_ids)
+        offsets, neighbours = face_adjacency(dims)
 
-                            self.mb.add_entities(
-                                adj, [self.primals[tuple(adj_id)]])
-                            adj_ids.append(tuple(adj_id))
+        primals = self.primals.array.ravel()
+        adjs = np.array([self.mb.create_meshset()
+                         for _ in primals], dtype='uint64')
 
-            self.mb.tag_set_data(self.primal_adj_tag, primal, adj)
+        for adj, start, end in zip(adjs, offsets[:-1], offsets[1:]):
+            self.mb.add_entities(adj, primals[neighbours[start:end]])
 
-            self.primal_adj[primal_id] = adj_ids
-
-    def _get_block_by_ijk(self, i, j, k):
-        # TODO: - Should go on Common
-        #       - Should reformulate to get self.mesh_size instead of input
-
-        """
-        Track down the block from its (i,j,k) position.
-        """
-        block = (k) * self.mesh_size[0] * self.mesh_size[1]+(
-            (i)+(j) * self.mesh_size[0])
-        return block
+        self.mb.tag_set_data(self.primal_adj_tag, primals, adjs)
+        self.primal_adj = AdjacencyMap(offsets, neighbours, dims)
 
     def _get_elem_by_ijk(self, ijk):
-        # TODO Should go on Common
-
-        block_id = self._get_block_by_ijk(
-            ijk[0], ijk[1], ijk[2])
-        elem = self.elems[block_id]
-        return elem  # Why not "return self.elems[block_id]" ?????
-
-    def read_phi(self):
-        # TODO: - Should go on Common
-        #       - This should go on .cfg
-        #       - It should have a if option for reading or for generating
-        phi_values = []
-        with open('spe_phi.dat') as phi:
-            for line in phi:
-                phi_values.extend(line.rstrip().split('        	'))
-        self.phi_values = [float(val) for val in phi_values]
-
-    def read_perm(self):
-        # TODO: - Should go on Common
-        #       - This should go on .cfg
-        #       - It should have a if option for reading or for generating
-
-        perm_values = []
-        with open('spe_perm.dat') as perm:
-            for line in perm:
-                line_list = line.rstrip().split('        	')
-                if len(line_list) > 1:
-                    perm_values.extend(line_list)
-        self.perm_values = [float(val) for val in perm_values]
+        return self.grid.handle(self.grid.index(ijk))
+
+    def _read_property(self, path, cache, model_size, origin, components):
+        if model_size is None:
+            return read_property(
+                path, cache, components * int(np.prod(self.mesh_size)))
+        return read_window(path, model_size, origin or (0, 0, 0),
+                           self.mesh_size, components, cache)
+
+    def read_phi(self, path='spe_phi.dat', cache=True, model_size=None,
+                 origin=None):
+        """Read the porosity of the fine cells. When model_size is given, the
+        file covers a model of that size and the mesh takes the box of cells
+        starting at the origin ijk index."""
+        self.phi_values = self._read_property(
+            path, cache, model_size, origin, 1)
+
+    def read_ntg(self, path, cache=True, model_size=None, origin=None):
+        """Read the net-to-gross ratio of the fine cells. See read_phi for
+        model_size and origin."""
+        self.ntg_values = self._read_property(
+            path, cache, model_size, origin, 1)
+
+    def read_perm(self, path='spe_perm.dat', cache=True, model_size=None,
+                  origin=None):
+        """Read the x, y and z permeabilities of the fine cells, one block of
+        cells after the other. See read_phi for model_size and origin."""
+        self.perm_values = self._read_property(
+            path, cache, model_size, origin, 3)
 
     def upscale_phi(self):
-        for _, primal in self.primals.iteritems():
-            # Calculate mean phi on primal
-            fine_elems_in_primal = self.mb.get_entities_by_type(
-                primal, types.MBHEX)
-            fine_elems_phi_values = self.mb.tag_get_data(self.phi_tag,
-                                                         fine_elems_in_primal)
-            primal_mean_phi = fine_elems_phi_values.mean()
-            # Store mean phi on the primal meshset and internal elements
-            self.mb.tag_set_data(self.primal_phi_tag, primal, primal_mean_phi)
-
-    def upscale_perm_mean(self, average_method):
+        """Upscale the porosity as the pore volume of each primal over its
+        bulk volume, the pore volume of fine cells being their bulk volume
+        times their porosity and, when read, their net-to-gross ratio."""
+        primals = self.primals.array.ravel()
+        volumes = self.grid.volumes(np.arange(self.grid.n_cells))
+        pore_volumes = volumes * self.fine_phi
+        if self.ntg_values is not None:
+            pore_volumes *= check_size('The net-to-gross map', np.asarray(
+                self.ntg_values, dtype='float64'), self.grid.n_cells)
+
+        primal_pore_volume = group_sums(
+            pore_volumes, self.fine_primal_ids, len(primals))
+        primal_phi = primal_pore_volume / group_sums(
+            volumes, self.fine_primal_ids, len(primals))
+
+        self.mb.tag_set_data(self.primal_phi_tag, primals, primal_phi)
+        self.mb.tag_set_data(
+            self.primal_pore_volume_tag, primals, primal_pore_volume)
+
+    def upscale_perm_mean(self, averages):
+        """Upscale the permeability with each of averages, given by name or
+        by power exponent (see parse_average). Each result is stored on its
+        own PRIMAL_PERM_<LABEL> tag, and the first one also on the coarse
+        permeability tags carried to the coarse grid."""
         self.primal_perm = (self.primal_perm_x_tag,
                             self.primal_perm_y_tag,
                             self.primal_perm_z_tag)
-        self.average_method = average_method
-        basis = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
-        perm = []
-        for primal_id, primal in self.primals.iteritems():
+        if not isinstance(averages, (list, tuple)):
+            averages = [averages]
+        try:
+            averages = collections.OrderedDict(
+                parse_average(average) for average in averages)
+        except ValueError:
+            print("Choose either Arithmetic, Geometric, Harmonic or power "
+                  "exponents.")
+            exit()
+        self.average_method = next(iter(averages))
+
+        primals = self.primals.array.ravel()
+        means = power_means(self.fine_perm, self.fine_primal_ids,
+                            len(primals), list(averages.values()))
+
+        for label, primal_perm in zip(averages, means):
+            tag = self.mb.tag_get_handle(
+                "PRIMAL_PERM_" + label.upper(), 9, types.MB_TYPE_DOUBLE,
+                types.MB_TAG_SPARSE, True)
+            self.mb.tag_set_data(tag, primals, _diagonal_tensors(primal_perm))
+            self.perm_averages[label] = primal_perm
+            self.perm_average_tags[label] = tag
 
-            fine_elems_in_primal = self.mb.get_entities_by_type(
-                primal, types.MBHEX)
-            fine_perm_values = self.mb.tag_get_data(self.perm_tag,
-                                                    fine_elems_in_primal)
-            primal_perm = [tensor.reshape(3, 3) for tensor in fine_perm_values]
-            for dim in range(0, 3):
-                perm = [(np.dot(np.dot(tensor, basis[dim]), basis[dim]))
-                        for tensor in primal_perm]
-                if average_method == 'Arithmetic':
-                    primal_perm[dim] = np.mean(perm)
-                elif average_method == 'Geometric':
-                    primal_perm[dim] = np.prod(np.asarray(
-                        perm)) ** len(1 / np.asarray(perm))
-                elif average_method == 'Harmonic':
-                    primal_perm[dim] = len(np.asarray(
-                        perm)) / sum(1/np.asarray(perm))
-                else:
-                    print("Choose either Arithmetic, Geometric or Harmonic.")
-                    exit()
-
-                perm = primal_perm[dim]
-                self.mb.tag_set_data(self.primal_perm[dim], primal, perm)
-
-            self.mb.tag_set_data(self.primal_perm_tag, primal,
-                                 [primal_perm[0], 0, 0,
-                                  0, primal_perm[1], 0,
-                                  0, 0, primal_perm[2]])
+        primal_perm = means[0]
+        for dim in range(0, 3):
+            self.mb.tag_set_data(self.primal_perm[dim], primals,
+                                 np.ascontiguousarray(primal_perm[:, dim]))
+        self.mb.tag_set_data(self.primal_perm_tag, primals,
+                             _diagonal_tensors(primal_perm))
+
+    def _primal_perm_diagonals(self):
+        primals = self.primals.array.ravel()
+        return np.column_stack([self.mb.tag_get_data(tag, primals, flat=True)
+                                for tag in self.primal_perm])
 
     def _primal_centroid(self, setid):
-        coarse_sums = np.array(
-            [[0, 0, 0],
-             [0, 0, 1],
-             [0, 1, 0],
-             [0, 1, 1],
-             [1, 0, 0],
-             [1, 0, 1],
-             [1, 1, 0],
-             [1, 1, 1]]
-        )
-        primal_centroid = (
-            (np.asarray(setid) + coarse_sums[0]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[1]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[2]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[3]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[4]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[5]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[6]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]) +
-            (np.asarray(setid) + coarse_sums[7]) *
-            np.array([self.coarse_ratio[0],
-                      self.coarse_ratio[1],
-                      self.coarse_ratio[2]]))
-
-        primal_centroid = primal_centroid // 8
-        return primal_centroid
+        return primal_centroids(np.atleast_2d(setid), self.coarse_ratio)[0]
 
     def get_boundary_meshsets(self):
-
+        """Tag the first (1.0) and last (0.0) layer of fine cells of every
+        primal along each axis, and gather both layers in one meshset per
+        primal and axis. A primal one cell thick along an axis only gets
+        the last layer's 0.0 there."""
         self.boundary_dir = (self.boundary_x_tag,
                              self.boundary_y_tag,
                              self.boundary_z_tag
                              )
         self.boundary_meshsets = {}
+
+        boxes = self._primal_boxes()
+        primals_ijk = grid_ijk(coarse_dims(self.primal_ids)).tolist()
         for dim in range(0, 3):
-            for k, idz in zip(xrange(self.mesh_size[2]),
-                              self.primal_ids[2]):
-                for j, idy in zip(xrange(self.mesh_size[1]),
-                                  self.primal_ids[1]):
-                    for i, idx in zip(xrange(self.mesh_size[0]),
-                                      self.primal_ids[0]):
-                        el = self._get_elem_by_ijk((i, j, k))
-                        if (i, j, k)[dim] == (self.coarse_ratio[dim] *
-                                              self.primal_ids[dim][(i, j,
-                                                                   k)[dim]]):
-                            self.mb.tag_set_data(self.boundary_dir[dim],
-                                                 el, 1.0)
-                            try:
-                                boundary_meshset = self.boundary_meshsets[
-                                                   (idx, idy, idz), dim]
-                                self.mb.add_entities(boundary_meshset, [el])
-
-                            except KeyError:
-                                boundary_meshset = self.mb.create_meshset()
-                                self.boundary_meshsets[
-                                    (idx, idy, idz), dim] = boundary_meshset
-                                self.mb.add_entities(boundary_meshset, [el])
-
-                        if (i, j, k)[dim] == (self.coarse_ratio[dim] *
-                                              self.primal_ids[dim][
-                                                  (i, j, k)[dim]] +
-                                              self._coarsening_ratio(dim)[
-                                                  self.primal_ids[dim][
-                                                   (i, j, k)[dim]]] - 1):
-                            self.mb.tag_set_data(
-                                self.boundary_dir[dim], el, 0.0)
-
-                            try:
-                                boundary_meshset = self.boundary_meshsets[
-                                                   (idx, idy, idz), dim]
-                                self.mb.add_entities(boundary_meshset, [el])
-
-                            except KeyError:
-                                boundary_meshset = self.mb.create_meshset()
-                                self.boundary_meshsets[
-                                    (idx, idy, idz), dim] = boundary_meshset
-                                self.mb.add_entities(boundary_meshset, [el])
+            for primal_ijk, (lo, hi) in zip(primals_ijk, boxes):
+                first_hi = list(hi)
+                first_hi[dim] = lo[dim] + 1
+                last_lo = list(lo)
+                last_lo[dim] = hi[dim] - 1
+                last = self.grid.box_index(last_lo, hi)
+                first = (self.grid.box_index(lo, first_hi)
+                         if hi[dim] - lo[dim] > 1 else last[:0])
+
+                elems = self.grid.handle(np.concatenate((first, last)))
+                self.mb.tag_set_data(
+                    self.boundary_dir[dim], elems,
+                    np.concatenate((np.ones(len(first)),
+                                    np.zeros(len(last)))))
+
+                boundary_meshset = self.mb.create_meshset()
+                self.mb.add_entities(boundary_meshset, elems)
+                self.boundary_meshsets[
+                    tuple(primal_ijk), dim] = boundary_meshset
 
     def set_global_problem(self):
         pass
 
-    def upscale_perm_flow_based(self, domain, dim, boundary_meshset):
+    def _primal_bounds(self):
+        # First fine cell of every primal along each axis, and the end of
+        # the axis
+        return [np.concatenate(([0], np.cumsum(np.bincount(ids))))
+                for ids in self.primal_ids]
+
+    def _primal_boxes(self):
+        # (lo, hi) bounds of the box of fine cells of each primal, in id
+        # order
+        bounds = self._primal_bounds()
+        return [([bounds[dim][i] for dim, i in enumerate(primal_ijk)],
+                 [bounds[dim][i + 1] for dim, i in enumerate(primal_ijk)])
+                for primal_ijk in grid_ijk(coarse_dims(self.primal_ids))]
+
+    def _primal_batches(self, boxes, dense_cells):
+        # Primal ids in batches of blocks of the same cell sizes, solved
+        # together when they have at most dense_cells cells
+        cell_sizes = [np.diff(nodes) for nodes in self.grid.nodes]
+        groups = collections.OrderedDict()
+        for primal_index, (lo, hi) in enumerate(boxes):
+            key = tuple(tuple(sizes[start:end]) for sizes, start, end in
+                        zip(cell_sizes, lo, hi))
+            groups.setdefault(key, []).append(primal_index)
+
+        batches = []
+        for block_sizes, indices in groups.items():
+            n_cells = int(np.prod([len(sizes) for sizes in block_sizes]))
+            dense = n_cells <= dense_cells
+            size = batch_size(n_cells, dense)
+            for start in range(0, len(indices), size):
+                batches.append((indices[start:start + size],
+                                [np.array(sizes) for sizes in block_sizes],
+                                dense))
+        return batches
+
+    def _batch_blocks(self, boxes, batches):
+        # The (perms, cell_sizes, dense) arguments of upscale_blocks for each
+        # batch
+        perm = self.fine_perm.reshape(self.mesh_size[::-1] + [3])
+        for indices, block_sizes, dense in batches:
+            perms = np.stack([
+                perm[tuple(slice(*box) for box in zip(*boxes[index]))[::-1]]
+                for index in indices])
+            yield perms, block_sizes, dense
+
+    def check_flow_based_primals(self):
+        """Raise a ValueError naming the first primal with fewer than three
+        fine cells along an axis, whose permeability the local flow problems
+        can not give (see FlowBasedUpscaling.effective_permeability)."""
+        primals_ijk = grid_ijk(coarse_dims(self.primal_ids)).tolist()
+        for primal_ijk, (lo, hi) in zip(primals_ijk, self._primal_boxes()):
+            extent = [int(end - start) for start, end in zip(lo, hi)]
+            if min(extent) < 3:
+                raise ValueError(
+                    "Primal {0} spans {1} fine cells in x, y and z; "
+                    "flow-based upscaling needs at least 3 along each "
+                    "axis.".format(tuple(primal_ijk), extent))
+
+    def flow_based_coarse_perm(self, workers=1, dense_cells=216):
+        """Upscale the permeability of every primal from its local flow
+        problems.
+
+        Blocks of the same shape with at most dense_cells cells are solved
+        in batches of dense systems, larger ones one at a time with the
+        sparse direct solver. Batches are spread over workers processes
+        when more than one. Each process only gets the blocks' arrays back
+        and forth, and the results are the same as those of a serial run.
+        Primals too thin for their local problems raise a ValueError, as
+        check_flow_based_primals does. FlowBasedUpscaling.solve upscales a
+        single block.
+        """
+        self.check_flow_based_primals()
         self.average_method = 'flow-based'
-        area = (self.block_size[1] * self.block_size[2],
-                self.block_size[0] * self.block_size[2],
-                self.block_size[0] * self.block_size[1],
-                )
-        pres_tag = self.mb.tag_get_handle(
-                   "Pressure", 1, types.MB_TYPE_DOUBLE,
-                   types.MB_TAG_SPARSE, True)
-        std_map = Epetra.Map(len(domain), 0, self.comm)
-        linear_vals = np.arange(0, len(domain))
-        id_map = dict(zip(domain, linear_vals))
-        boundary_elms = set()
-
-        b = Epetra.Vector(std_map)
-        x = Epetra.Vector(std_map)
-
-        A = Epetra.CrsMatrix(Epetra.Copy, std_map, 3)
-
-        t0 = time.time()
-        for elem in boundary_meshset:
-            if elem in boundary_elms:
-                continue
-            boundary_elms.add(elem)
-            idx = id_map[elem]
-            A.InsertGlobalValues(idx, [1], [idx])
-            b[idx] = self.mb.tag_get_data(self.boundary_dir[dim], elem,
-                                          flat=True)
-
-        self.mb.tag_set_data(pres_tag, domain, np.repeat(0.0, len(domain)))
-        t1 = time.time()
-        for elem in (set(domain) ^ boundary_elms):
-
-            adj_volumes = self.mesh_topo_util.get_bridge_adjacencies(
-                          np.asarray([elem]), 2, 3, 0)
-            adj_volumes = [elems for elems in adj_volumes if elems in domain]
-            adj_volumes_set = set(adj_volumes)
-
-            elem_center = self.mesh_topo_util.get_average_position(
-                                   np.asarray([elem]))
-            K1 = self.mb.tag_get_data(self.perm_tag, [elem], flat=True)
-            adj_perms = []
-            for adjacencies in range(len(adj_volumes)):
-                adj_perms.append(self.mb.tag_get_data(
-                                 self.perm_tag, adj_volumes, flat=True)[
-                                 adjacencies*9:(adjacencies+1)*9])
-            values = []
-            ids = []
-            for K2, adj in zip(adj_perms, adj_volumes_set):
-                adj_center = self.mesh_topo_util.get_average_position(
-                             np.asarray([adj]))
-                N = elem_center - adj_center
-                N = N / np.sqrt(N[0] ** 2 + N[1] ** 2 + N[2] ** 2)
-                K1proj = np.dot(np.dot(N, K1.reshape([3, 3])), N)
-                K2proj = np.dot(np.dot(N, K2.reshape([3, 3])), N)
-                dl = np.linalg.norm((elem_center - adj_center)/2)
-                K_eq = (2 * K1proj * K2proj) / (K1proj * dl + K2proj * dl)
-                values.append(- K_eq)
-                if adj in id_map:
-                    ids.append(id_map[adj])
-            values.append(-sum(values))
-            idx = id_map[elem]
-            ids.append(idx)
-            A.InsertGlobalValues(idx, values, ids)
-        A.FillComplete()
-        t2 = time.time()
-
-        linearProblem = Epetra.LinearProblem(A, x, b)
-        solver = AztecOO.AztecOO(linearProblem)
-        solver.SetAztecOption(AztecOO.AZ_output, AztecOO.AZ_warnings)
-        solver.Iterate(300, 1e-9)
-        # """
-        self.mb.tag_set_data(pres_tag, domain, np.asarray(x))
-        print("took {0} seconds to solve.".format(time.time() - t2))
-        # Get the flux - should break down in another part
-        flow_rate = 0.0
-        total_area = 0.0
-        for elem in boundary_meshset:
-            elem_center = self.mesh_topo_util.get_average_position(
-                          np.asarray([elem]))
-            adj_volumes = self.mesh_topo_util.get_bridge_adjacencies(
-                     np.asarray([elem]), 2, 3)
-            adj_volumes_set = set(adj_volumes).intersection(set(domain))
-            adj_to_boundary_volumes = set()
-            for el in adj_volumes_set:
-                if el in boundary_meshset:
-                    adj_to_boundary_volumes.add(el)
-            adj_volumes_set = adj_volumes_set - adj_to_boundary_volumes
-            for adj in adj_volumes_set:
-                adj_center = self.mesh_topo_util.get_average_position(
-                                 np.asarray([adj]))
-                N = elem_center - adj_center
-                N = N / np.sqrt(N[0] ** 2 + N[1] ** 2 + N[2] ** 2)
-                adj_pres = self.mb.tag_get_data(pres_tag, adj)
-                adj_perm = np.dot(N, np.dot(self.mb.tag_get_data(
-                                  self.perm_tag, adj).reshape(
-                                  [3, 3]), N))
-                elem_perm = np.dot(N, np.dot(self.mb.tag_get_data(
-                                   self.perm_tag, elem).reshape(
-                                   [3, 3]), N))
-                dl = np.linalg.norm((elem_center - adj_center)/2)
-                K_equiv = (2 * adj_perm * elem_perm) / (adj_perm * dl +
-                                                        elem_perm * dl)
-
-                flow_rate = flow_rate + area[dim] * K_equiv * adj_pres / dl
-                total_area = total_area + area[dim]
-            perm = flow_rate * dl / total_area
-        return perm
-
-    def flow_based_coarse_perm(self):
-
         self.primal_perm = (self.primal_perm_x_tag,
                             self.primal_perm_y_tag,
                             self.primal_perm_z_tag)
         self.get_boundary_meshsets()
 
+        primals = self.primals.array.ravel()
+        n_primals = len(primals)
+        primal_perm = np.empty((n_primals, 3))
+        boxes = self._primal_boxes()
+        batches = self._primal_batches(boxes, dense_cells)
+        blocks = self._batch_blocks(boxes, batches)
+
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(upscale_blocks, blocks,
+                                -(-len(batches) // (4 * workers)))
+        else:
+            results = (upscale_blocks(batch_blocks)
+                       for batch_blocks in blocks)
+
+        done = 0
+        try:
+            for n, batch_perm in enumerate(results):
+                indices, _, dense = batches[n]
+                primal_perm[indices] = batch_perm
+                done += len(indices)
+                self.instrumentation.progress(done, n_primals)
+                self.instrumentation.count(
+                    'dense_solves' if dense else 'linear_solves',
+                    1 if dense else len(indices))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
         for primal_id, primal in self.primals.iteritems():
-            print("iterating over meshset {0}".format(primal_id))
-            fine_elems_in_primal = self.mb.get_entities_by_type(
-                    primal, types.MBHEX)
-            # The A matrix should be called here
             for dim in range(0, 3):
-                self.mb.add_child_meshset(self.primals[(primal_id)],
-                                          self.boundary_meshsets[
+                self.mb.add_child_meshset(primal, self.boundary_meshsets[
                                           primal_id, dim])
-                boundary = self.mb.get_entities_by_handle(np.asarray(
-                           self.boundary_meshsets[primal_id, dim]))
-                perm = self.upscale_perm_flow_based(fine_elems_in_primal, dim,
-                                                    boundary)
-                self.mb.tag_set_data(self.primal_perm[dim], primal, perm)
+        for dim in range(0, 3):
+            self.mb.tag_set_data(self.primal_perm[dim], primals,
+                                 np.ascontiguousarray(primal_perm[:, dim]))
 
     def coarse_grid(self):
         # We should include a switch for either printing coarse grid or fine
@@ -670,58 +524,36 @@ class StructuredUpscalingMethods:
         """
         fine_grid = self.mb.get_entities_by_type(self.root_set, types.MBHEX)
         self.mb.delete_entities(fine_grid)
-        coarse_vertices = self.create_coarse_vertices()
+        coarse_vertices = handles_array(self.create_coarse_vertices())
         coarse_dims = self._coarse_dims()
-        cur_id = 0
-        for k in xrange(coarse_dims[2]):
-            print("{0} / {1}".format(k + 1, coarse_dims[2]))
-            for j in xrange(coarse_dims[1]):
-                for i in xrange(coarse_dims[0]):
-
-                    hexa = self._create_hexa(i, j, k,
-                                             coarse_vertices,
-                                             coarse_dims)
-                    el = self.mb.create_element(types.MBHEX, hexa)
-
-        # Assign coarse scale properties previously calculated
-
-                    self.mb.tag_set_data(
-                        self.coarse_gid_tag, el, cur_id)
-                    self.mb.tag_set_data(self.primal_phi_tag, el,
-                                         self.mb.tag_get_data(
-                                             self.primal_phi_tag,
-                                             self.primals[(i, j, k)]))
-                    self.mb.tag_set_data(self.primal_perm_tag, el, [
-                        self.mb.tag_get_data(self.primal_perm[0],
-                                             self.primals[(i, j, k)]), 0, 0,
-                        0, self.mb.tag_get_data(self.primal_perm[1],
-                                                self.primals[(i, j, k)]), 0, 0,
-                        0, self.mb.tag_get_data(self.primal_perm[2],
-                                                self.primals[(i, j, k)])])
-                    self.mb.tag_set_data(self.abs_perm_x_tag, el,
-                                         self.mb.tag_get_data(self.primal_perm[
-                                             0], self.primals[(i, j, k)]))
-                    self.coarse_elems.append(el)
-                    cur_id += 1
-
-    def _get_block_by_ijk_coarse(self, i, j, k):
-            # TODO: - Should go on Common
-            #       - Should reformulate to get self.mesh_size instead of input
-        mesh_size_coarse = self._coarse_dims()
-        """
-            Track down the block from its (i,j,k) position.
-        """
-        block = (k) * mesh_size_coarse[0] * mesh_size_coarse[1]+(
-                (i)+(j) * mesh_size_coarse[0])
-        return block
+        coarse_elems = handles_array(self.mb.create_elements(
+            types.MBHEX, coarse_vertices[cell_vertex_ids(coarse_dims)]))
+        self.coarse_grid_index = StructuredGrid(
+            coarse_dims,
+            [np.diff(nodes) for nodes in self.get_block_size_coarse()],
+            coarse_elems)
+
+        # Assign coarse scale properties previously calculated. Coarse
+        # volumes are numbered as the primals are
+        primals = self.primals.array.ravel()
+        primal_perm = self._primal_perm_diagonals()
+        self.mb.tag_set_data(self.coarse_gid_tag, coarse_elems,
+                             np.arange(len(coarse_elems), dtype='int32'))
+        for tag in (self.primal_phi_tag, self.primal_pore_volume_tag):
+            self.mb.tag_set_data(
+                tag, coarse_elems,
+                self.mb.tag_get_data(tag, primals, flat=True))
+        self.mb.tag_set_data(self.primal_perm_tag, coarse_elems,
+                             _diagonal_tensors(primal_perm))
+        self.mb.tag_set_data(self.abs_perm_x_tag, coarse_elems,
+                             np.ascontiguousarray(primal_perm[:, 0]))
+        for tag in self.perm_average_tags.values():
+            self.mb.tag_set_data(
+                tag, coarse_elems,
+                self.mb.tag_get_data(tag, primals, flat=True))
 
     def _get_elem_by_ijk_coarse(self, ijk):
-            # TODO Should go on Common
-
-        block_id = self._get_block_by_ijk_coarse(
-                ijk[0], ijk[1], ijk[2])
-        elem = self.coarse_elems[block_id]
-        return elem
+        return self.coarse_grid_index.handle(self.coarse_grid_index.index(ijk))
 
     def create_wells(self):
         mesh_size_coarse = self._coarse_dims()
@@ -776,62 +608,37 @@ class StructuredUpscalingMethods:
                              self.injection_wells_coarse[1], 1)
     # def solve_it():
 
+    def _write_coarse_values(self, output, values):
+        # A blank line before each layer and row of coarse volumes, and a row
+        # per line
+        mesh_size_coarse = self._coarse_dims()
+        for layer in np.reshape(values, mesh_size_coarse[::-1]):
+            output.write('\n')
+            for row in layer:
+                output.write('\n')
+                output.write('        \t'.join('%f' % value for value in row))
+                output.write('\n')
+
     def export_data(self):
         writedir = ('I', 'J', 'K')
-        mesh_size_coarse = self._coarse_dims()
+        primals = self.primals.array.ravel()
         with open('coarse_phi{0}_{1}.dat'.format(
                   self.coarse_ratio, self.average_method), 'w') as coarse_phi:
             coarse_phi.write('*POR *ALL')
             coarse_phi.write('\n')
-            for k in xrange(mesh_size_coarse[2]):
-                # coarse_phi.write('-- LAYER  {0}'.format(k+1))
-                coarse_phi.write('\n')
-                for j in xrange(mesh_size_coarse[1]):
-
-                    # coarse_phi.write('-- ROW  {0}'.format(j+1))
-                    coarse_phi.write('\n')
-                    for i in xrange(mesh_size_coarse[0]):
-                        if i < mesh_size_coarse[0] - 1:
-                            coarse_phi.write('%f' % (self.mb.tag_get_data(
-                                                self.primal_phi_tag,
-                                                self.primals[(i, j, k)])
-                                                   )
-                                             )
-                            coarse_phi.write('        	')
-                        else:
-                            coarse_phi.write('%f' % (self.mb.tag_get_data(
-                                         self.primal_phi_tag,
-                                         self.primals[(i, j, k)])
-                                               )
-                                         )
-                            coarse_phi.write('\n')
-            coarse_phi.close()
-        with open('coarse_perm{0}_{1}.dat'.format(
-                  self.coarse_ratio, self.average_method), 'w') as coarse_perm:
-            for dim in range(0, 3):
-                coarse_perm.write('*PERM{0} *ALL'.format(writedir[dim]))
-                coarse_perm.write('\n')
-                for k in xrange(mesh_size_coarse[2]):
-                    # coarse_perm.write('-- LAYER  {0}'.format(k+1))
+            self._write_coarse_values(coarse_phi, self.mb.tag_get_data(
+                self.primal_phi_tag, primals, flat=True))
+
+        # One file per average when several were computed
+        perm_averages = self.perm_averages or {
+            self.average_method: self._primal_perm_diagonals()}
+        for label, primal_perm in perm_averages.items():
+            with open('coarse_perm{0}_{1}.dat'.format(
+                      self.coarse_ratio, label), 'w') as coarse_perm:
+                for dim in range(0, 3):
+                    coarse_perm.write('*PERM{0} *ALL'.format(writedir[dim]))
                     coarse_perm.write('\n')
-                    for j in xrange(mesh_size_coarse[1]):
-                        # coarse_perm.write('-- ROW  {0}'.format(j+1))
-                        coarse_perm.write('\n')
-                        for i in xrange(mesh_size_coarse[0]):
-                            if i < mesh_size_coarse[0] - 1:
-
-                                coarse_perm.write(
-                                    '%f' % (self.mb.tag_get_data(
-                                        self.primal_perm[dim],
-                                        self.primals[(i, j, k)])))
-                                coarse_perm.write('        	')
-                            else:
-                                coarse_perm.write(
-                                    '%f' % (self.mb.tag_get_data(
-                                        self.primal_perm[dim],
-                                        self.primals[(i, j, k)])))
-                                coarse_perm.write('\n')
-            coarse_perm.close()
+                    self._write_coarse_values(coarse_perm, primal_perm[:, dim])
 
     def export(self, outfile):
         self.mb.write_file(outfile)
@@ -2,16 +2,16 @@ import time
 
 from pymoab import core
 from pymoab import types
-from pymoab import topo_util
 import numpy as np
 from PyTrilinos import Epetra, AztecOO, Amesos
 
+from presto.Preprocessors.Common.StructuredGrid import StructuredGrid
+
 USE_DIRECT_SOLVER = False
 
 comm = Epetra.PyComm()
 mb = core.Core()
 root_set = mb.get_root_set()
-mesh_topo_util = topo_util.MeshTopoUtil(mb)
 
 
 print "Loading..."
@@ -59,6 +59,23 @@ perm_values = mb.tag_get_data(coarse_perm_tag, volumes)
 
 v_ids = mb.tag_get_data(gid_tag, volumes).flatten()
 v_ids = np.subtract(v_ids, np.min(v_ids))
+
+# The coarse grid is structured, numbered with x varying fastest: neighbours
+# and geometry follow from the coordinates of its volumes' vertices. The
+# fine grid's vertices are still in the file and must be left out.
+coords = mb.get_coords(
+    np.unique(mb.get_connectivity(volumes))).reshape(-1, 3)
+nodes = [np.unique(coords[:, dim]) for dim in range(3)]
+grid = StructuredGrid([len(n) - 1 for n in nodes], [np.diff(n) for n in nodes])
+if grid.n_cells != len(volumes):
+    raise ValueError("The {0} coarse volumes do not make up the {1} grid "
+                     "of their vertices.".format(len(volumes), grid.mesh_size))
+neighbours = grid.neighbours(np.arange(grid.n_cells))
+half_dists = grid.half_distances(np.arange(grid.n_cells))
+
+perms = np.empty((len(volumes), 3, 3))
+perms[v_ids] = perm_values.reshape(-1, 3, 3)
+
 std_map = Epetra.Map(len(volumes), 0, comm)
 A = Epetra.CrsMatrix(Epetra.Copy, std_map, 0)
 
@@ -82,9 +99,6 @@ for idx, elem in zip(v_ids, volumes):
         print percent, "%"
         count = 0
 
-    adj_volumes = mesh_topo_util.get_bridge_adjacencies(
-        np.asarray([elem]), 2, 3, 0)
-    adj_volumes_set = set(adj_volumes)
     boundary = False
 
     for tag, well_elems in tag2injection_well.iteritems():
@@ -102,31 +116,19 @@ for idx, elem in zip(v_ids, volumes):
 
     if not boundary:
 
-        elem_center = mesh_topo_util.get_average_position(np.asarray([elem]))
-        K1 = mb.tag_get_data(coarse_perm_tag, [elem], flat=True)
-
-        #adj_perms = mb.tag_get_data(coarse_perm_tag, adj_volumes, flat=True)
-        adj_perms = []
-        for adjacencies in range(len(adj_volumes)):
-            adj_perms.append(mb.tag_get_data(
-                     coarse_perm_tag, adj_volumes, flat=True)[
-                     adjacencies*9:(adjacencies+1)*9])
-
-
         values = []
-
-        for K2, adj in zip(adj_perms, adj_volumes_set):
-            adj_center = mesh_topo_util.get_average_position(
-                         np.asarray([adj]))
-            N = elem_center - adj_center
-            N = N / np.sqrt(N[0] ** 2 + N[1] ** 2 + N[2] ** 2)
-            K1proj = np.dot(np.dot(N, K1.reshape([3, 3])), N)
-            K2proj = np.dot(np.dot(N, K2.reshape([3, 3])), N)
-            dl = np.linalg.norm((elem_center - adj_center)/2)
+        ids = []
+
+        for col, adj in enumerate(neighbours[idx]):
+            if adj < 0:
+                continue
+            axis = col // 2
+            K1proj = perms[idx, axis, axis]
+            K2proj = perms[adj, axis, axis]
+            dl = (half_dists[idx, axis] + half_dists[adj, axis]) / 2
             K_eq = (2 * K1proj * K2proj) / (K1proj * dl + K2proj * dl)
             values.append(- K_eq)
-
-        ids = mb.tag_get_data(gid_tag, adj_volumes)
+            ids.append(adj)
 
         values = np.append(values, -(np.sum(values)))
 
@@ -6,6 +6,6 @@ setup(
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'pytest-cov', 'pytest-mock'],
     install_requires=['elliptic'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     license='LICENSE'
 )